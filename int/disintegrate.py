@@ -1,23 +1,140 @@
-import os, os.path, re, sys
-import xml.dom.minidom as md
+import os, os.path, re, sys, shutil
+import html.parser
 import logging
+import threading
+import argparse, hashlib, json, contextlib, asyncio, time, datetime
+import urllib.parse
+import concurrent.futures
 import requests
-import tidylib
 
 logging.basicConfig(filename='disintegrate.log',level=logging.DEBUG)
 
 URLBASE = "https://2017.integralmaths.org"
 BASEDIR = "./resources"
-#COURSES = (26, 27, 47, 48, 9, 78, 51, 52, 55)
-COURSES = (26, )
+COURSES = (26, 27, 47, 48, 9, 78, 51, 52, 55)
 
+# how many requests we have going at once, in all and to any one host
+WORKERS = 8
+PER_HOST = 4
 
-def cleanedHtml(messy_html):
-    return tidylib.tidy_document(
-        messy_html, options = {'output-xhtml' : True ,
-                               'input-encoding' : 'utf-8',
-                               'output-encoding' : 'utf-8' }
-    )[0]
+# resources are written as they arrive, this much at a time, with only as
+# many downloads going at once as keeps their chunks within MEMORY_LIMIT
+CHUNK_SIZE = 64 * 1024
+MEMORY_LIMIT = 8 * 1024 * 1024
+
+# how many links away from a course page we look for sections, and the
+# sections we leave out
+DEPTH = 1
+EXCLUDED_SECTIONS = ("Large data set",)
+
+# what we got for each resource url last time, kept in the base folder,
+# along with an account of the last crawl
+MANIFEST_NAME = ".disintegrate-manifest.json"
+MANIFEST_VERSION = 1
+PART_SUFFIX = ".part"
+# where downloads are written until they are finished, each to its own file
+PARTS_FOLDER = ".parts"
+REPORT_NAME = "crawl-report.json"
+
+# each different resource is kept once, named by its sha256, in this folder
+# of the base folder, and linked to from wherever it belongs
+BLOB_FOLDER = ".blobs"
+
+
+# elements that never have an end tag
+VOID_ELEMENTS = frozenset(("area", "base", "basefont", "br", "col", "embed", "frame",
+                           "hr", "img", "input", "isindex", "link", "meta", "param",
+                           "source", "track", "wbr"))
+
+class PageScanner(html.parser.HTMLParser):
+    """Picks out what we want from a Moodle page in a single pass: every
+    link, and the named sections.  A section is an h3 of class
+    "sectionname", whose first bit of text is its name; its links are
+    all those inside the h3's parent element, and each link's title is the
+    first bit of text in the first span inside it.  Tags left open are
+    closed along with whatever they're inside, as tidy would."""
+
+    def __init__(self):
+        html.parser.HTMLParser.__init__(self, convert_charrefs = True)
+        # every href, in the order they come
+        self.links = []
+        # (name, [(href, title)]) for each section, in the order they end
+        self.sections = []
+        # the names of the open elements
+        self._stack = []
+        # [depth of the parent, name, links] for each section still open
+        self._open_sections = []
+        # the link we're after the title of: [href, title, depth of the a]
+        self._link = None
+        # the section or link whose name or title is the text we're in
+        self._want_text = None
+
+    def handle_starttag(self, tag, attrs):
+        self._want_text = None
+        attrs = dict(attrs)
+        if tag == "a":
+            href = attrs.get("href") or ""
+            self.links.append(href)
+            self._link = None
+            if self._open_sections and href.find("/mod/resource/") > -1:
+                self._link = [href, None, len(self._stack)]
+                for section in self._open_sections:
+                    section[2].append(self._link)
+        elif tag == "span" and self._link and self._link[1] is None:
+            self._link[1] = ""
+            self._want_text = self._link
+        elif tag == "h3" and attrs.get("class") == "sectionname":
+            section = [len(self._stack) - 1, "", []]
+            self._open_sections.append(section)
+            self._want_text = section
+        if tag not in VOID_ELEMENTS:
+            self._stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._want_text = None
+        if tag not in self._stack:
+            return
+        while self._stack.pop() != tag:
+            pass
+        depth = len(self._stack)
+        if self._link and self._link[2] >= depth:
+            self._link = None
+        while self._open_sections and self._open_sections[-1][0] >= depth:
+            self.endSection()
+
+    def handle_data(self, data):
+        # both keep their text second
+        if self._want_text is not None:
+            self._want_text[1] += data
+
+    def endSection(self):
+        depth, name, links = self._open_sections.pop()
+        self.sections.append((name, [(href, title) for href, title, d in links]))
+
+    def close(self):
+        html.parser.HTMLParser.close(self)
+        while self._open_sections:
+            self.endSection()
+
+def scanPage(text):
+    """Returns a PageScanner that has been through the page"""
+    page = PageScanner()
+    page.feed(text)
+    page.close()
+    return page
+
+def fileHash(path, chunk_size = CHUNK_SIZE):
+    """Returns a sha256 object fed with the file at path, a chunk at a time"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha
 
 def _cleanSectionName(thename):
     return re.sub("""[\s][\s]+""",
@@ -26,90 +143,588 @@ def _cleanSectionName(thename):
     ).replace(":",",").strip()
 
 
+class Fetcher:
+    """The transport Mirror uses unless it is given another: a requests
+    session, shared between the worker threads, which keeps no more than
+    per_host requests going to any one host at a time"""
 
-def getIn():
-    s = requests.Session()
-    r = s.post(URLBASE+"/login/index.php",
-               data = {'username' : "fmsp-Allerton959",
-                       'password' : "Give101%",
-               }
-    )
-    
-    # now let's grab the "courses" we want
+    def __init__(self, workers = WORKERS, per_host = PER_HOST):
+        self.session = requests.Session()
+        # keep a connection open for each worker, rather than the
+        # default ten per host
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize = workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.per_host = per_host
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._limits[host]
+
+    def get(self, url, **kwargs):
+        with self._limit(url):
+            return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        with self._limit(url):
+            return self.session.post(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        with self._limit(url):
+            return self.session.head(url, allow_redirects = True, **kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, url, **kwargs):
+        """Like get, but the body is left to be read as it arrives, and the
+        host counts it as going until the with block is done"""
+        with self._limit(url):
+            r = self.session.get(url, stream = True, **kwargs)
+            try:
+                yield r
+            finally:
+                r.close()
+
+
+class Mirror:
+    """Copies the resources of some courses into basedir.  The crawl starts
+    from each course page, and works through a queue of pages and
+    resources with workers at a time in flight.  Sections are followed up
+    to depth links away from the course page, never twice, and leaving out
+    any url matching one of the exclude_urls patterns or section whose name
+    starts with one of exclude_sections.  What was found, fetched and left
+    out goes in a report in basedir.
+
+    Requests go through the transport: anything with get, post, head and
+    stream methods like Fetcher's, which are called from worker threads.
+
+    What came back for each resource is kept in a manifest, so that next
+    time the server is only asked for it if it has changed (unless force
+    is set), and a download that was cut short carries on from where it
+    got to.  Resources are streamed to disk in chunk_size pieces, with
+    no more downloads at once than fit memory_limit.
+
+    Each different file is stored once in BLOB_FOLDER, under its sha256,
+    and hard linked (or copied, where it can't be) to every path it
+    belongs at.  Before downloading a url it hasn't had before, the
+    server is asked for just its headers, and if the ETag and size are
+    those of a file already got from another url, that file is used.
+    Once a run has finished, blobs the manifest no longer has are deleted."""
+
+    def __init__(self, transport, urlbase = URLBASE, basedir = BASEDIR, workers = WORKERS,
+                 force = False, chunk_size = CHUNK_SIZE, memory_limit = MEMORY_LIMIT,
+                 depth = DEPTH, exclude_sections = EXCLUDED_SECTIONS, exclude_urls = ()):
+        self.transport = transport
+        self.urlbase = urlbase
+        self.basedir = basedir
+        self.workers = workers
+        self.force = force
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.exclude_sections = tuple(exclude_sections)
+        self.exclude_urls = [re.compile(pattern) for pattern in exclude_urls]
+        self._downloads = threading.BoundedSemaphore(max(1, memory_limit // chunk_size))
+        self.manifest = {}
+        # how many resources were downloaded, resumed, found unchanged,
+        # found to be the same as one we had from elsewhere, and couldn't
+        # be had
+        self.counts = dict.fromkeys(("downloaded", "resumed", "unchanged", "deduplicated",
+                                     "failed"), 0)
+        self.report = {}
+        # { (url, path) : the least depth it was found at } for everything
+        # that has been queued or left out
+        self._seen = {}
+        # { (etag, size) : sha256 } for the blobs we have
+        self._blobs = {}
+        # { path : lock } so only one resource at a time is put at a path
+        self._path_locks = {}
+        self._lock = threading.Lock()
+
+    def run(self, courses):
+        """Mirrors the given course ids, returning once everything is
+        fetched.  The first thing to go wrong stops the lot, though what
+        was fetched until then is still noted in the manifest and report.
+        Blobs no longer in the manifest are only thrown away after a run
+        that got to the end."""
+        self.manifest = self.readManifest()
+        for entry in self.manifest.values():
+            self.addBlob(entry)
+        self.report = {'courses' : list(courses), 'pages' : [], 'resources' : [],
+                       'skipped' : [], 'error' : None,
+                       'started' : datetime.datetime.now().isoformat(timespec = "seconds")}
+        started = time.monotonic()
+        try:
+            asyncio.run(self.crawl(courses))
+            self.removeUnusedBlobs()
+        except BaseException as e:
+            self.report['error'] = repr(e)
+            raise
+        finally:
+            self.writeManifest(self.manifest)
+            self.report['seconds'] = round(time.monotonic() - started, 3)
+            self.writeReport()
+        return self.counts
+
+    async def crawl(self, courses):
+        # the blocking requests and file writes go to our own threads
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(self.workers))
+        queue = asyncio.Queue()
+        for courseid in courses:
+            self.follow(queue, "page", self.courseUrl(courseid), 0, courseid)
+        workers = [asyncio.create_task(self.work(queue)) for i in range(self.workers)]
+        finished = asyncio.create_task(queue.join())
+        try:
+            done, _ = await asyncio.wait(workers + [finished],
+                                         return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                # passes on anything that went wrong in a worker
+                task.result()
+        finally:
+            for task in workers + [finished]:
+                task.cancel()
+            await asyncio.gather(*workers, finished, return_exceptions = True)
+
+    async def work(self, queue):
+        while True:
+            kind, url, depth, courseid, path = await queue.get()
+            try:
+                if kind == "page":
+                    await self.crawlPage(queue, url, depth, courseid)
+                else:
+                    await asyncio.to_thread(self.getResource, url, path)
+            finally:
+                queue.task_done()
+
+    def follow(self, queue, kind, url, depth, courseid, path = None):
+        """Puts a page or resource on the queue, unless it has been seen
+        already or is to be left out.  A page goes by the least depth it is
+        found at, so one first found along a path too long for the limit is
+        queued after all if a shorter one turns up, and one crawled already
+        is crawled again for the sections it can now reach."""
+        url = url.split("#")[0]
+        last = self._seen.get((url, path))
+        if last is not None and (kind != "page" or last <= depth):
+            return
+        self._seen[(url, path)] = depth
+        if any(pattern.search(url) for pattern in self.exclude_urls):
+            if last is None:
+                self.skip(url, "excluded url")
+        elif kind == "page" and depth > self.depth:
+            if last is None:
+                self.skip(url, "too deep")
+        else:
+            if last is not None and last > self.depth:
+                self.unskip(url, "too deep")
+            queue.put_nowait((kind, url, depth, courseid, path))
 
-    for courseid in COURSES:
-        # download the course overview page - this should have a nice
-        # listing of all the sections in its menu
-        course_url = URLBASE+"/course/view.php?id="+str(courseid)
-        r = s.get(course_url)
-        logging.debug("Tried to fetch course overview page: "+str(r.url))
-
-        logging.debug("Trying to parse minidom")
-        doc = md.parseString(cleanedHtml(r.text).encode('utf-8'))
-
-        logging.debug("Looking for sections")
-        section_urls = []
-        for el in doc.getElementsByTagName("a"):
-            href = el.getAttribute("href")
-
-            # check if this href points to a section, and don't
-            # duplicate
-            if href.startswith(course_url) and href.find("section=") >= 0:
-                if href not in section_urls:
-                    section_urls.append(href) 
+    def skip(self, url, reason):
+        logging.debug("Leaving out %s (%s)" % (url, reason))
+        with self._lock:
+            self.report['skipped'].append({'url' : url, 'reason' : reason})
+
+    def unskip(self, url, reason):
+        with self._lock:
+            self.report['skipped'] = [skip for skip in self.report['skipped']
+                                      if skip != {'url' : url, 'reason' : reason}]
+
+    def courseUrl(self, courseid):
+        return self.urlbase+"/course/view.php?id="+str(courseid)
+
+    def fetchPage(self, url):
+        r = self.transport.get(url)
+        logging.debug("Tried to fetch page: "+str(r.url))
+        return r, scanPage(r.text)
+
+    async def crawlPage(self, queue, url, depth, courseid):
+        """Looks through a course or section page for the sections of the
+        course, which are followed in turn, and any resources"""
+        r, page = await asyncio.to_thread(self.fetchPage, url)
+        section_urls = getSectionUrls(page, self.courseUrl(courseid))
         logging.debug(
-            "The section urls we have are: " + "; ".join(section_urls)
+            "The section urls on %s are: %s" % (url, "; ".join(section_urls))
         )
-                    
-        # now go to each section separately and look for "resource" links
         for sec_url in section_urls:
-            logging.debug("Looking up section: "+sec_url)
-            r = s.get(sec_url)
-            doc = md.parseString(cleanedHtml(r.text))
-
-            # let's grab the section name and make a directory with
-            # that (cleaned up) name
-
-            h3s = doc.getElementsByTagName('h3')
-            for h3 in h3s:
-                if h3.getAttribute("class") == "sectionname":
-                    # clean up the name to make a directory
-                    sname = _cleanSectionName(h3.firstChild.data)
-                    if sname.startswith("Large data set"):
-                        continue
-                    os.makedirs(
-                        os.path.join(BASEDIR,str(courseid),sname),
-                        exist_ok = True)
-
-                    # for each link that looks like a resource, attempt to
-                    # follow a redirect link, but first work out what name the
-                    # pdf file should have
-
-                    for a in h3.parentNode.getElementsByTagName('a'):
-                        href = a.getAttribute("href")
-                        if href.find("/mod/resource/")>-1:
-                            namespan = a.getElementsByTagName('span')[0].firstChild.data
-                            cleanname = re.sub("\\W", "",namespan) + ".pdf"
-                            outfile = open(
-                                os.path.join(BASEDIR,str(courseid),sname,cleanname),
-                                "wb"
-                                )
-                            logging.debug("Trying to get %s into %s" % (href, cleanname))
-                            r = s.get(href+"&redirect=1")
-                            outfile.write(r.content)
-                            outfile.close()
-                            
+            self.follow(queue, "page", sec_url, depth + 1, courseid)
 
-if __name__ == "__main__":
-    getIn()
+        sections = []
+        for sname, resources in getResources(page, ()):
+            if sname.startswith(self.exclude_sections):
+                self.skip(url, "excluded section " + sname)
+                continue
+            sections.append(sname)
+            os.makedirs(
+                os.path.join(self.basedir,str(courseid),sname),
+                exist_ok = True)
+            for href, cleanname in resources:
+                self.follow(queue, "resource", href, depth + 1, courseid,
+                            os.path.join(self.basedir,str(courseid),sname,cleanname))
+        with self._lock:
+            # only the shallowest crawl of a page counts
+            pages = [page for page in self.report['pages'] if page['url'] != url]
+            pages.append({'url' : url, 'course' : courseid, 'depth' : depth,
+                          'status' : r.status_code, 'sections' : sections})
+            self.report['pages'] = pages
+
+    def readManifest(self):
+        """Returns { url : entry } from the last run, or nothing if there
+        isn't a manifest we can use"""
+        try:
+            with open(os.path.join(self.basedir, MANIFEST_NAME), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['resources']
+
+    def writeManifest(self, resources):
+        with self._lock:
+            self.writeJSON(MANIFEST_NAME, {'version' : MANIFEST_VERSION, 'resources' : resources})
+
+    def writeReport(self):
+        with self._lock:
+            self.report['counts'] = dict(self.counts)
+            self.writeJSON(REPORT_NAME, self.report)
+
+    def writeJSON(self, name, thing):
+        path = os.path.join(self.basedir, name)
+        os.makedirs(self.basedir, exist_ok = True)
+        with open(path + PART_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(thing, f, sort_keys = True, indent = 1)
+        os.replace(path + PART_SUFFIX, path)
+
+    def count(self, what):
+        with self._lock:
+            self.counts[what] += 1
+
+    def getResource(self, href, path):
+        """Brings the file at path up to date with the resource at href.
+        Anything the server doesn't give us is logged and left as it was."""
+        with self._lock:
+            lock = self._path_locks.setdefault(path, threading.Lock())
+        with lock:
+            self.updateResource(href, path)
+
+    def partPath(self, href, path):
+        return os.path.join(self.basedir, PARTS_FOLDER, partName(href, path))
+
+    def updateResource(self, href, path):
+        with self._lock:
+            last = self.manifest.get(href, {})
+        part_path = self.partPath(href, path)
+        headers = {}
+        offset = 0
+        r = None
+        if self.force:
+            pass
+        elif os.path.exists(part_path) and last.get('partial') and \
+                (last.get('etag') or last.get('last_modified')):
+            # carry on from the end of the last attempt, if the resource
+            # is still the one we were getting then
+            offset = os.path.getsize(part_path)
+            headers['Range'] = "bytes=%d-" % offset
+            headers['If-Range'] = last.get('etag') or last['last_modified']
+        elif not last.get('partial') and self.haveBlob(last, path):
+            # we have it already, so only want it if it has changed
+            if last.get('etag'):
+                headers['If-None-Match'] = last['etag']
+            if last.get('last_modified'):
+                headers['If-Modified-Since'] = last['last_modified']
+        else:
+            # we haven't, but may have from another url
+            r = self.matchBlob(href, path)
+
+        logging.debug("Trying to get %s into %s" % (href, path))
+        if r is not None:
+            outcome = "deduplicated"
+        else:
+            with self._downloads, \
+                    self.transport.stream(href+"&redirect=1", headers = headers) as r:
+                outcome = self.writeResource(href, path, r, last, offset)
+            if outcome is None:
+                # what we had of it was no use, so get all of it
+                with self._downloads, self.transport.stream(href+"&redirect=1") as r:
+                    outcome = self.writeResource(href, path, r, last, 0)
+        self.count(outcome)
+        with self._lock:
+            self.report['resources'].append({
+                'url' : href, 'path' : os.path.relpath(path, self.basedir),
+                'status' : r.status_code, 'outcome' : outcome,
+                'size' : self.manifest.get(href, {}).get('size')})
+
+    def writeResource(self, href, path, r, last, offset):
+        """Writes the response to the resource at href into path, where
+        last is its manifest entry from before and offset how much of it
+        the .part file already has.  Returns which of the counts it was,
+        or None if the .part file had to be thrown away and the resource
+        should be asked for again from the start."""
+        part_path = self.partPath(href, path)
+        if r.status_code == 304:
+            logging.debug("%s is unchanged" % href)
+            self.placeBlob(last['sha256'], path)
+            return "unchanged"
+        if r.status_code == 416 and offset:
+            if r.headers.get('Content-Range') != "bytes */%d" % offset:
+                logging.warning("What we had of %s doesn't fit it (%s), so starting again" %
+                                (href, r.headers.get('Content-Range')))
+                os.remove(part_path)
+                return None
+            # the last attempt got all of it, but stopped before putting it
+            # in place
+            entry = dict(last, path = os.path.relpath(path, self.basedir))
+            self.storeResource(href, path, entry, fileHash(part_path, self.chunk_size), offset)
+            return "resumed"
+        if r.status_code not in (200, 206):
+            logging.error("Could not get %s: %d %s" % (href, r.status_code, r.reason))
+            return "failed"
+        if r.status_code == 206 and \
+                not r.headers.get('Content-Range', '').startswith("bytes %d-" % offset):
+            logging.error("Could not carry on with %s: got %s" %
+                          (href, r.headers.get('Content-Range')))
+            os.remove(part_path)
+            return "failed"
+
+        # note what we're getting before we write any of it, so a partial
+        # file can be carried on with next time
+        entry = {
+            'path' : os.path.relpath(path, self.basedir),
+            'etag' : r.headers.get('ETag'),
+            'last_modified' : r.headers.get('Last-Modified'),
+            'partial' : True,
+        }
+        with self._lock:
+            self.manifest[href] = entry
+        if r.status_code == 206:
+            sha = fileHash(part_path, self.chunk_size)
+            size = offset
+            outfile = open(part_path, "ab")
+        else:
+            os.makedirs(os.path.dirname(part_path), exist_ok = True)
+            sha = hashlib.sha256()
+            size = 0
+            outfile = open(part_path, "wb")
+        try:
+            for chunk in r.iter_content(self.chunk_size):
+                outfile.write(chunk)
+                sha.update(chunk)
+                size += len(chunk)
+        finally:
+            outfile.close()
+
+        placed = self.storeResource(href, path, entry, sha, size)
+        if not placed and not self.force and r.status_code == 200:
+            # the server couldn't tell us it hadn't changed, but it hasn't
+            return "unchanged"
+        return "resumed" if r.status_code == 206 else "downloaded"
+
+    def storeResource(self, href, path, entry, sha, size):
+        """Puts the finished .part file for href and path in the store,
+        given its sha256 object and size, and links path to it.  Returns
+        whether path was changed."""
+        entry = dict(entry, partial = False, size = size, sha256 = sha.hexdigest())
+        blob = self.blobPath(entry['sha256'])
+        part_path = self.partPath(href, path)
+        if self.holds(blob, entry['sha256'], size):
+            # the same as something we have, from here or elsewhere
+            os.remove(part_path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok = True)
+            os.replace(part_path, blob)
+        with self._lock:
+            self.manifest[href] = entry
+            self.addBlob(entry)
+        return self.placeBlob(entry['sha256'], path)
 
-    
-                            
+    def blobPath(self, sha256):
+        return os.path.join(self.basedir, BLOB_FOLDER, sha256[:2], sha256)
 
+    def addBlob(self, entry):
+        """Notes the ETag and size of a manifest entry's blob, so another
+        url the server answers with the same can share it.  Weak ETags
+        don't say the bytes are the same, so are no use."""
+        etag = entry.get('etag')
+        if etag and not etag.startswith("W/") and not entry.get('partial') \
+                and entry.get('sha256'):
+            self._blobs[(etag, entry['size'])] = entry['sha256']
 
+    def removeUnusedBlobs(self):
+        """Deletes the blobs that nothing in the manifest is any more"""
+        used = set(entry.get('sha256') for entry in self.manifest.values())
+        for folder, dirs, files in os.walk(os.path.join(self.basedir, BLOB_FOLDER),
+                                           topdown = False):
+            for name in files:
+                if name not in used:
+                    logging.info("Removing unused blob %s" % name)
+                    os.remove(os.path.join(folder, name))
+            if folder != os.path.join(self.basedir, BLOB_FOLDER) and not os.listdir(folder):
+                os.rmdir(folder)
 
-            
-            
+    def holds(self, path, sha256, size):
+        """Whether the file at path is the one with this sha256 and size"""
+        try:
+            if os.path.getsize(path) != size:
+                return False
+        except OSError:
+            return False
+        return fileHash(path, self.chunk_size).hexdigest() == sha256
 
+    def haveBlob(self, entry, path):
+        """Whether the blob for a manifest entry is in the store.  A file
+        at path from before there was a store is put there, if it is the
+        one the entry describes."""
+        if not entry.get('sha256') or entry.get('size') is None:
+            return False
+        blob = self.blobPath(entry['sha256'])
+        if os.path.exists(blob):
+            return True
+        if self.holds(path, entry['sha256'], entry['size']):
+            os.makedirs(os.path.dirname(blob), exist_ok = True)
+            linkFile(path, blob)
+            return True
+        return False
 
+    def placeBlob(self, sha256, path):
+        """Links path to the blob, returning whether it wasn't already"""
+        blob = self.blobPath(sha256)
+        if os.path.exists(path) and os.path.samefile(blob, path):
+            return False
+        linkFile(blob, path)
+        return True
 
+    def matchBlob(self, href, path):
+        """Asks the server for the headers of the resource at href, and if
+        they match a blob we have, and the blob is still what its name
+        says, links path to it and notes it in the manifest.  Returns the
+        response if so, and None if it has to be downloaded after all."""
+        with self._lock:
+            if self.force or not self._blobs:
+                return None
+        r = self.transport.head(href+"&redirect=1")
+        try:
+            size = int(r.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            sha256 = self._blobs.get((r.headers.get('ETag'), size))
+        if r.status_code != 200 or sha256 is None:
+            return None
+        if not self.holds(self.blobPath(sha256), sha256, size):
+            logging.warning("The blob %s for %s is missing or damaged" % (sha256, href))
+            return None
+        logging.debug("%s is the same as %s" % (href, sha256))
+        self.placeBlob(sha256, path)
+        with self._lock:
+            self.manifest[href] = {
+                'path' : os.path.relpath(path, self.basedir),
+                'etag' : r.headers.get('ETag'),
+                'last_modified' : r.headers.get('Last-Modified'),
+                'partial' : False,
+                'size' : size,
+                'sha256' : sha256,
+            }
+        return r
+
+
+def partName(href, path):
+    """Returns the name of the .part file the resource at href is written
+    to on its way to path"""
+    key = "%s\n%s" % (href, path)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest() + PART_SUFFIX
+
+def linkFile(source, target):
+    """Puts a hard link to source at target, or a copy of it where the
+    file system can't have links, replacing whatever was there"""
+    temp = "%s.%d%s" % (target, threading.get_ident(), PART_SUFFIX)
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copyfile(source, temp)
+    os.replace(temp, target)
+
+def getSectionUrls(page, course_url):
+    """Returns the links in a page that point to sections of the course,
+    in the order they first come"""
+    section_urls = []
+    seen = set()
+    for href in page.links:
+        # check if this href points to a section, and don't
+        # duplicate
+        if href.startswith(course_url) and href.find("section=") >= 0:
+            if href not in seen:
+                seen.add(href)
+                section_urls.append(href)
+    return section_urls
+
+def getResources(page, exclude = EXCLUDED_SECTIONS):
+    """Yields (section name, [(href, file name)]) for each section in a
+    page, listing the resources it links to, and leaving out those whose
+    names start with one of exclude"""
+    for name, links in page.sections:
+        # clean up the name to make a directory
+        sname = _cleanSectionName(name)
+        if sname.startswith(tuple(exclude)):
+            continue
+
+        # for each link that looks like a resource, we'll attempt to
+        # follow a redirect link, but first work out what name the
+        # pdf file should have
+        resources = []
+        # { name : href } so that two resources whose names come out the
+        # same don't end up in the same file
+        names = {}
+        for href, title in links:
+            if not title:
+                logging.warning("Resource %s in %s has no name" % (href, sname))
+                continue
+            cleanname = basename = re.sub("\\W", "",title)
+            n = 1
+            while names.setdefault(cleanname, href) != href:
+                n += 1
+                cleanname = "%s-%d" % (basename, n)
+            if n > 1:
+                logging.warning("Resource %s in %s is called %s, as %s is taken" %
+                                (href, sname, cleanname, basename))
+            resources.append((href, cleanname + ".pdf"))
+        yield sname, resources
+
+
+def getIn(urlbase = URLBASE, basedir = BASEDIR, courses = COURSES,
+          workers = WORKERS, per_host = PER_HOST, force = False,
+          chunk_size = CHUNK_SIZE, memory_limit = MEMORY_LIMIT,
+          depth = DEPTH, exclude_urls = (), transport = None):
+    """Logs in and mirrors the courses, returning how many resources were
+    downloaded, resumed, unchanged, deduplicated and failed"""
+    if transport is None:
+        transport = Fetcher(workers, per_host)
+    r = transport.post(urlbase+"/login/index.php",
+               data = {'username' : "fmsp-Allerton959",
+                       'password' : "Give101%",
+               }
+    )
+
+    # now let's grab the "courses" we want
+    return Mirror(transport, urlbase, basedir, workers, force, chunk_size, memory_limit,
+                  depth, exclude_urls = exclude_urls).run(courses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Mirror the integralmaths resources")
+    parser.add_argument("--force", "-f", action = "store_true",
+                        help = "download every resource, even those we already have")
+    parser.add_argument("--memory", "-m", type = int, default = MEMORY_LIMIT // (1024 * 1024),
+                        metavar = "MB",
+                        help = "how much of the downloads to hold in memory at once")
+    parser.add_argument("--depth", "-d", type = int, default = DEPTH,
+                        help = "how many links away from a course page to look for sections")
+    parser.add_argument("--exclude", "-x", action = "append", default = [], metavar = "PATTERN",
+                        help = "leave out urls matching this regular expression")
+    args = parser.parse_args()
+    counts = getIn(force = args.force, memory_limit = args.memory * 1024 * 1024,
+                   depth = args.depth, exclude_urls = args.exclude)
+    print("%(downloaded)d downloaded, %(resumed)d resumed, %(unchanged)d unchanged, "
+          "%(deduplicated)d deduplicated, %(failed)d failed" % counts)
@@ -0,0 +1,554 @@
+import unittest, os, shutil, threading, tempfile, time, json, hashlib, contextlib, re
+import http.server
+import disintegrate
+
+COURSE_PAGE = """<html><head><title>Course</title></head><body>
+<ul class="menu">
+<li><a href="%(base)s/course/view.php?id=26&amp;section=1">Algebra</a></li>
+<li><a href="%(base)s/course/view.php?id=26&amp;section=2">Data</a></li>
+<li><a href="%(base)s/course/view.php?id=26&amp;section=1">Algebra again</a></li>
+<li><a href="%(base)s/course/view.php?id=27&amp;section=1">Another course</a></li>
+</ul>
+</body></html>"""
+
+SECTION_PAGES = {
+    "1" : """<html><head><title>Section</title></head><body>
+<div class="section"><h3 class="sectionname">Topic 1:  Algebra   and functions</h3>
+<ul>%s</ul></div>
+</body></html>""",
+    "2" : """<html><head><title>Section</title></head><body>
+<div class="section"><h3 class="sectionname">Large data set</h3>
+<ul><li><a href="%(base)s/mod/resource/view.php?id=900"><span>Data set</span></a></li></ul></div>
+</body></html>""",
+}
+
+RESOURCES = 6
+
+
+class StubMoodle(http.server.ThreadingHTTPServer):
+    """Serves canned course, section and resource pages, keeping count of
+    how many requests it is answering at once.  Resources have an ETag,
+    which changes with their version, and can be asked for in part.  A
+    resource in same_as is served as a copy of another."""
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StubMoodleHandler)
+        self.base = "http://127.0.0.1:%d" % self.server_port
+        self.requested = []
+        self.heads = []
+        self.ranges = []
+        self.versions = [1] * RESOURCES
+        self.same_as = {}
+        self.active = 0
+        self.most_active = 0
+        self.downloading = 0
+        self.most_downloading = 0
+        self.lock = threading.Lock()
+
+    def getETag(self, path):
+        for n in range(RESOURCES):
+            if path == "/mod/resource/view.php?id=%d&redirect=1" % (100 + n):
+                n = self.same_as.get(n, n)
+                return '"%d-%d"' % (n, self.versions[n])
+        return None
+
+    def getPage(self, path):
+        """Returns the bytes for a path, or None if there's no such page"""
+        links = "".join(
+            '<li><a href="%s/mod/resource/view.php?id=%d"><span>Notes (part %d)</span></a></li>'
+            % (self.base, 100 + n, n) for n in range(RESOURCES))
+        if path == "/course/view.php?id=26":
+            return (COURSE_PAGE % {'base' : self.base}).encode("utf-8")
+        for section, page in SECTION_PAGES.items():
+            if path == "/course/view.php?id=26&section=" + section:
+                if section == "1":
+                    page = page % links
+                return (page % {'base' : self.base}).encode("utf-8")
+        for n in range(RESOURCES):
+            if path == "/mod/resource/view.php?id=%d&redirect=1" % (100 + n):
+                n = self.same_as.get(n, n)
+                return ("%%PDF-1.4 part %d version %d\n" % (n, self.versions[n])).encode("ascii") * 1000
+        return None
+
+
+class StubMoodleHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.heads.append(self.path)
+        body = self.server.getPage(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        etag = self.server.getETag(self.path)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requested.append(self.path)
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        etag = None
+        try:
+            # long enough for the other requests to catch up
+            time.sleep(0.05)
+            body = server.getPage(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            etag = server.getETag(self.path)
+            if etag:
+                with server.lock:
+                    server.downloading += 1
+                    server.most_downloading = max(server.most_downloading, server.downloading)
+            if etag and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            start = 0
+            if etag and self.headers.get("Range") and self.headers.get("If-Range") == etag:
+                start = int(self.headers["Range"][len("bytes="):-1])
+                with server.lock:
+                    server.ranges.append((self.path, start))
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % len(body))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body)))
+            else:
+                self.send_response(200)
+            if etag:
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", "Mon, 04 Sep 2017 09:00:00 GMT")
+            self.send_header("Content-Length", str(len(body) - start))
+            self.end_headers()
+            self.wfile.write(body[start:])
+        finally:
+            with server.lock:
+                server.active -= 1
+                if etag:
+                    server.downloading -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+MESSY_SECTION_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Section</title>
+<body>
+<ul class="topics">
+<li class="section main"><div class="left side"></div>
+<div class="content"><h3 class="sectionname">Pure &amp; applied:
+  <b>week 1</b></h3><br>
+<ul class="section img-text">
+<li class="activity resource"><a href="/mod/resource/view.php?id=7"><img src="pdf.png" alt=""><span class="instancename">Sine &amp; cosine rules<span class="accesshide"> File</span></span></a>
+<li class="activity url"><a href="/mod/url/view.php?id=8"><span>Elsewhere</span></a>
+<li class="activity resource"><a href="/mod/resource/view.php?id=9"><span class="instancename">Radians</span></a></li>
+</ul></div>
+<li class="section main"><div class="content"><h3 class="sectionname">Large data set</h3>
+<a href="/mod/resource/view.php?id=10"><span>Data</span></a></div></li>
+</ul>
+<a href="/mod/resource/view.php?id=11"><span>Outside any section</span></a>
+</body></html>"""
+
+
+class TestPageScanner(unittest.TestCase):
+
+    def test_messyPage(self):
+        # unclosed tags, void elements and entities, as tidy used to sort out
+        page = disintegrate.scanPage(MESSY_SECTION_PAGE)
+        self.assertEqual(page.links, ["/mod/resource/view.php?id=7", "/mod/url/view.php?id=8",
+                                      "/mod/resource/view.php?id=9", "/mod/resource/view.php?id=10",
+                                      "/mod/resource/view.php?id=11"])
+        self.assertEqual(list(disintegrate.getResources(page)),
+                         [("Pure & applied,", [("/mod/resource/view.php?id=7", "Sinecosinerules.pdf"),
+                                               ("/mod/resource/view.php?id=9", "Radians.pdf")])])
+        self.assertEqual(page.sections[1], ("Large data set", [("/mod/resource/view.php?id=10", "Data")]))
+
+
+class FixtureResponse:
+
+    def __init__(self, url, status_code, content = b""):
+        self.url = url
+        self.status_code = status_code
+        self.reason = "OK" if status_code == 200 else "Not Found"
+        self.content = content
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class FixtureTransport:
+    """Answers requests from a dict of { url : page } without going near
+    the network, noting every url asked for, and taking the time given in
+    delays over any of them"""
+
+    def __init__(self, pages, delays = {}):
+        self.pages = pages
+        self.delays = delays
+        self.requested = []
+
+    def get(self, url, **kwargs):
+        self.requested.append(url)
+        time.sleep(self.delays.get(url, 0))
+        if url not in self.pages:
+            return FixtureResponse(url, 404)
+        return FixtureResponse(url, 200, self.pages[url].encode("utf-8"))
+
+    def post(self, url, **kwargs):
+        return FixtureResponse(url, 200)
+
+    def head(self, url, **kwargs):
+        r = self.get(url)
+        r.content = b""
+        return r
+
+    @contextlib.contextmanager
+    def stream(self, url, **kwargs):
+        yield self.get(url)
+
+
+FIXTURE_BASE = "https://fixture.test"
+
+def fixtureSection(name, resources, sections = ()):
+    links = "".join('<a href="%s/course/view.php?id=26&amp;section=%d">%d</a>' % (FIXTURE_BASE, n, n)
+                    for n in sections)
+    items = "".join('<li><a href="%s/mod/resource/view.php?id=%d"><span>R%d</span></a></li>'
+                    % (FIXTURE_BASE, n, n) for n in resources)
+    return ('<html><body><div class="nav">%s</div><div><h3 class="sectionname">%s</h3>'
+            '<ul>%s</ul></div></body></html>' % (links, name, items))
+
+FIXTURE_PAGES = {
+    FIXTURE_BASE + "/course/view.php?id=26" : fixtureSection("", [], (1, 2, 1)).replace(
+        '<h3 class="sectionname"></h3>',
+        '<a href="%s/course/view.php?id=27&amp;section=1">27</a>' % FIXTURE_BASE),
+    FIXTURE_BASE + "/course/view.php?id=26&section=1" : fixtureSection("Algebra", (1, 2), (1, 2, 3)),
+    FIXTURE_BASE + "/course/view.php?id=26&section=2" : fixtureSection("Large data set", (3,), (1, 2)),
+    FIXTURE_BASE + "/course/view.php?id=26&section=3" : fixtureSection("Calculus", (4, 1), (4,)),
+    FIXTURE_BASE + "/course/view.php?id=26&section=4" : fixtureSection("Extra", (5,)),
+}
+for n in range(1, 6):
+    FIXTURE_PAGES[FIXTURE_BASE + "/mod/resource/view.php?id=%d&redirect=1" % n] = "%%PDF R%d" % n
+
+
+class TestCrawl(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.basedir.cleanup()
+
+    def crawl(self, depth, pages = FIXTURE_PAGES, delays = {}):
+        transport = FixtureTransport(pages, delays)
+        counts = disintegrate.getIn(urlbase = FIXTURE_BASE, basedir = self.basedir.name,
+                                    courses = (26,), depth = depth, transport = transport,
+                                    exclude_urls = [r"id=2$"])
+        with open(os.path.join(self.basedir.name, disintegrate.REPORT_NAME), encoding="utf-8") as f:
+            report = json.load(f)
+        return transport, counts, report
+
+    def files(self):
+        found = []
+        for folder, dirs, files in os.walk(os.path.join(self.basedir.name, "26")):
+            found += [os.path.join(os.path.basename(folder), name) for name in files]
+        return sorted(found)
+
+    def test_depth(self):
+        transport, counts, report = self.crawl(depth = 1)
+        self.assertEqual(self.files(), [os.path.join("Algebra", "R1.pdf")])
+        self.assertEqual(counts["downloaded"], 1)
+        # every page once, however many times it is linked to
+        self.assertEqual(len(transport.requested), len(set(transport.requested)))
+        self.assertEqual(sorted((page["depth"], page["sections"]) for page in report["pages"]),
+                         [(0, []), (1, []), (1, ["Algebra"])])
+        self.assertEqual(sorted(skip["reason"] for skip in report["skipped"]),
+                         ["excluded section Large data set", "excluded url", "too deep"])
+        self.assertEqual([r["outcome"] for r in report["resources"]], ["downloaded"])
+        self.assertIsNone(report["error"])
+        self.assertEqual(report["counts"], counts)
+
+    def test_deeper(self):
+        transport, counts, report = self.crawl(depth = 2)
+        self.assertEqual(self.files(), [os.path.join("Algebra", "R1.pdf"),
+                                        os.path.join("Calculus", "R1.pdf"),
+                                        os.path.join("Calculus", "R4.pdf")])
+        self.assertEqual([skip["url"] for skip in report["skipped"] if skip["reason"] == "too deep"],
+                         [FIXTURE_BASE + "/course/view.php?id=26&section=4"])
+        # one copy of R1, wherever it goes
+        self.assertTrue(os.path.samefile(os.path.join(self.basedir.name, "26", "Algebra", "R1.pdf"),
+                                         os.path.join(self.basedir.name, "26", "Calculus", "R1.pdf")))
+
+    def test_shorterPathFoundLater(self):
+        # section 4 is too deep by way of 1 and 3, which come back first,
+        # but not by way of the slow section 5
+        section = FIXTURE_BASE + "/course/view.php?id=26&section=%d"
+        pages = {
+            FIXTURE_BASE + "/course/view.php?id=26" : fixtureSection("", [], (1, 5)),
+            section % 1 : fixtureSection("Algebra", (), (3,)),
+            section % 3 : fixtureSection("Calculus", (), (4,)),
+            section % 4 : fixtureSection("Extra", (6,)),
+            section % 5 : fixtureSection("Mechanics", (), (4,)),
+            FIXTURE_BASE + "/mod/resource/view.php?id=6&redirect=1" : "%PDF R6",
+        }
+        transport, counts, report = self.crawl(depth = 2, pages = pages,
+                                               delays = {section % 5 : 0.2})
+        self.assertEqual(self.files(), [os.path.join("Extra", "R6.pdf")])
+        self.assertEqual(report["skipped"], [])
+        self.assertEqual([page["depth"] for page in report["pages"] if page["url"] == section % 4],
+                         [2])
+
+    def test_sameNames(self):
+        # eight resources all called Notes, and another in a second section
+        # that goes to the same folder
+        section = FIXTURE_BASE + "/course/view.php?id=26&section=%d"
+        pages = {
+            FIXTURE_BASE + "/course/view.php?id=26" : fixtureSection("", [], (1, 2)),
+            section % 1 : re.sub("R\\d+", "Notes", fixtureSection("Algebra", range(11, 19))),
+            section % 2 : re.sub("R\\d+", "Notes", fixtureSection("Algebra", (19,))),
+        }
+        for n in range(11, 20):
+            pages[FIXTURE_BASE + "/mod/resource/view.php?id=%d&redirect=1" % n] = "%%PDF R%d" % n
+        transport, counts, report = self.crawl(depth = 2, pages = pages)
+        self.assertEqual(counts["failed"], 0)
+        self.assertEqual(self.files(), sorted([os.path.join("Algebra", "Notes.pdf")] +
+                                              [os.path.join("Algebra", "Notes-%d.pdf" % n)
+                                               for n in range(2, 9)]))
+        for n in range(2, 9):
+            with open(os.path.join(self.basedir.name, "26", "Algebra", "Notes-%d.pdf" % n)) as f:
+                self.assertEqual(f.read(), "%%PDF R%d" % (n + 10))
+        # the one both sections want is one or the other, never a mixture
+        with open(os.path.join(self.basedir.name, "26", "Algebra", "Notes.pdf")) as f:
+            self.assertIn(f.read(), ("%PDF R11", "%PDF R19"))
+        # and everything in the store is what its name says it is
+        for folder, dirs, files in os.walk(os.path.join(self.basedir.name, disintegrate.BLOB_FOLDER)):
+            for name in files:
+                with open(os.path.join(folder, name), "rb") as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), name)
+        self.assertEqual(os.listdir(os.path.join(self.basedir.name, disintegrate.PARTS_FOLDER)), [])
+
+
+class TestDisintegrate(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubMoodle()
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.start()
+        self.basedir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.basedir.cleanup()
+
+    def mirror(self, **kwargs):
+        return disintegrate.getIn(urlbase = self.server.base, basedir = self.basedir.name,
+                                  courses = (26,), **kwargs)
+
+    def resourcePath(self, n):
+        return os.path.join(self.basedir.name, "26", "Topic 1, Algebra and functions",
+                            "Notespart%d.pdf" % n)
+
+    def resourceBody(self, n):
+        return self.server.getPage("/mod/resource/view.php?id=%d&redirect=1" % (100 + n))
+
+    def test_mirror(self):
+        counts = self.mirror(workers = 8, per_host = 3)
+        self.assertEqual(counts["downloaded"], RESOURCES)
+        folder = os.path.join(self.basedir.name, "26", "Topic 1, Algebra and functions")
+        self.assertEqual(sorted(os.listdir(os.path.join(self.basedir.name, "26"))),
+                         ["Topic 1, Algebra and functions"])
+        self.assertEqual(sorted(os.listdir(folder)),
+                         ["Notespart%d.pdf" % n for n in range(RESOURCES)])
+        for n in range(RESOURCES):
+            with open(os.path.join(folder, "Notespart%d.pdf" % n), "rb") as f:
+                self.assertEqual(f.read(), self.server.getPage(
+                    "/mod/resource/view.php?id=%d&redirect=1" % (100 + n)))
+
+        # each section only once, and nothing from the large data set
+        self.assertEqual(len(self.server.requested), 3 + RESOURCES)
+        # the downloads went on side by side, but no more than per_host at once
+        self.assertGreater(self.server.most_active, 1)
+        self.assertLessEqual(self.server.most_active, 3)
+
+    def test_sync(self):
+        self.mirror()
+        for n in range(RESOURCES):
+            os.utime(self.resourcePath(n), ns = (0, 0))
+
+        # the second time round, the server says nothing has changed
+        counts = self.mirror()
+        self.assertEqual(counts["unchanged"], RESOURCES)
+        self.assertEqual(counts["downloaded"], 0)
+        self.assertEqual([os.stat(self.resourcePath(n)).st_mtime_ns for n in range(RESOURCES)],
+                         [0] * RESOURCES)
+
+        # only what has changed is downloaded again
+        self.server.versions[2] += 1
+        counts = self.mirror()
+        self.assertEqual((counts["downloaded"], counts["unchanged"]), (1, RESOURCES - 1))
+        with open(self.resourcePath(2), "rb") as f:
+            self.assertEqual(f.read(), self.resourceBody(2))
+
+        self.assertEqual(self.mirror(force = True)["downloaded"], RESOURCES)
+
+    def test_unusedBlobs(self):
+        self.mirror()
+        old = self.blobPath(self.resourceBody(2))
+        self.assertTrue(os.path.exists(old))
+
+        # a newer version leaves nothing pointing at the old one
+        self.server.versions[2] += 1
+        self.mirror()
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.samefile(self.resourcePath(2), self.blobPath(self.resourceBody(2))))
+        for n in range(RESOURCES):
+            self.assertTrue(os.path.exists(self.blobPath(self.resourceBody(n))))
+
+    def test_streaming(self):
+        # with room for one chunk, the downloads take turns
+        counts = self.mirror(workers = 8, per_host = 8, chunk_size = 1000, memory_limit = 1500)
+        self.assertEqual(counts["downloaded"], RESOURCES)
+        self.assertEqual(self.server.most_downloading, 1)
+        manifest_path = os.path.join(self.basedir.name, disintegrate.MANIFEST_NAME)
+        with open(manifest_path, encoding="utf-8") as f:
+            resources = json.load(f)["resources"]
+        for n in range(RESOURCES):
+            with open(self.resourcePath(n), "rb") as f:
+                self.assertEqual(f.read(), self.resourceBody(n))
+            entry = resources[self.server.base + "/mod/resource/view.php?id=%d" % (100 + n)]
+            self.assertEqual(entry["sha256"], hashlib.sha256(self.resourceBody(n)).hexdigest())
+            self.assertEqual(entry["size"], len(self.resourceBody(n)))
+
+    def blobPath(self, body):
+        sha256 = hashlib.sha256(body).hexdigest()
+        return os.path.join(self.basedir.name, disintegrate.BLOB_FOLDER, sha256[:2], sha256)
+
+    def partPath(self, href, path):
+        return os.path.join(self.basedir.name, disintegrate.PARTS_FOLDER,
+                            disintegrate.partName(href, path))
+
+    def stopPartWay(self, part):
+        """Makes it look as if the last run was stopped with part written
+        of the first resource"""
+        path = self.resourcePath(0)
+        href = self.server.base + "/mod/resource/view.php?id=100"
+        os.makedirs(os.path.dirname(self.partPath(href, path)), exist_ok = True)
+        with open(self.partPath(href, path), "wb") as f:
+            f.write(part)
+        os.remove(path)
+        manifest_path = os.path.join(self.basedir.name, disintegrate.MANIFEST_NAME)
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        manifest["resources"][href]["partial"] = True
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        # and without the finished file in the store
+        shutil.rmtree(os.path.join(self.basedir.name, disintegrate.BLOB_FOLDER))
+        return path, manifest_path, href
+
+    def test_resume(self):
+        self.mirror()
+        path, manifest_path, href = self.stopPartWay(self.resourceBody(0)[:1000])
+
+        counts = self.mirror()
+        self.assertEqual((counts["resumed"], counts["unchanged"]), (1, RESOURCES - 1))
+        self.assertEqual(self.server.ranges, [("/mod/resource/view.php?id=100&redirect=1", 1000)])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.resourceBody(0))
+        self.assertFalse(os.path.exists(self.partPath(href, path)))
+        with open(manifest_path, encoding="utf-8") as f:
+            entry = json.load(f)["resources"][href]
+        self.assertEqual(entry["sha256"], hashlib.sha256(self.resourceBody(0)).hexdigest())
+
+    def test_resumeFinished(self):
+        # everything was got last time, it just wasn't put in place
+        self.mirror()
+        path, manifest_path, href = self.stopPartWay(self.resourceBody(0))
+        counts = self.mirror()
+        self.assertEqual((counts["resumed"], counts["failed"]), (1, 0))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.resourceBody(0))
+        self.assertFalse(os.path.exists(self.partPath(href, path)))
+
+        # more than there is to get, so it has to start again
+        path, manifest_path, href = self.stopPartWay(self.resourceBody(0) + b"extra")
+        counts = self.mirror()
+        self.assertEqual((counts["downloaded"], counts["failed"]), (1, 0))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.resourceBody(0))
+        self.assertFalse(os.path.exists(self.partPath(href, path)))
+        with open(manifest_path, encoding="utf-8") as f:
+            self.assertFalse(json.load(f)["resources"][href]["partial"])
+
+    def test_blobsAreChecked(self):
+        self.mirror(workers = 1)
+        # a file from before the store that is the right size, but not the
+        # right file, isn't taken into the store
+        shutil.rmtree(os.path.join(self.basedir.name, disintegrate.BLOB_FOLDER))
+        with open(self.resourcePath(0), "r+b") as f:
+            f.write(b"X")
+        counts = self.mirror(workers = 1)
+        self.assertEqual((counts["downloaded"], counts["unchanged"]), (1, RESOURCES - 1))
+        with open(self.resourcePath(0), "rb") as f:
+            self.assertEqual(f.read(), self.resourceBody(0))
+
+        # nor is a damaged blob linked to from a resource that matches it
+        with open(self.resourcePath(1), "r+b") as f:
+            f.write(b"X")
+        self.server.same_as = {3 : 1}
+        manifest_path = os.path.join(self.basedir.name, disintegrate.MANIFEST_NAME)
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        del manifest["resources"][self.server.base + "/mod/resource/view.php?id=103"]
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        counts = self.mirror(workers = 1)
+        self.assertEqual(counts["deduplicated"], 0)
+        with open(self.resourcePath(3), "rb") as f:
+            self.assertEqual(f.read(), self.resourceBody(1))
+
+    def test_dedup(self):
+        # 3 and 5 are copies of 1, which one worker gets to first
+        self.server.same_as = {3 : 1, 5 : 1}
+        counts = self.mirror(workers = 1)
+        self.assertEqual((counts["downloaded"], counts["deduplicated"]), (RESOURCES - 2, 2))
+        self.assertEqual(len(self.server.requested), 3 + RESOURCES - 2)
+        for n in range(RESOURCES):
+            with open(self.resourcePath(n), "rb") as f:
+                self.assertEqual(f.read(), self.resourceBody(n))
+        self.assertTrue(os.path.samefile(self.resourcePath(1), self.resourcePath(3)))
+        self.assertTrue(os.path.samefile(self.resourcePath(1), self.resourcePath(5)))
+        blobs = []
+        for folder, dirs, files in os.walk(os.path.join(self.basedir.name, disintegrate.BLOB_FOLDER)):
+            blobs += files
+        self.assertEqual(sorted(blobs), sorted(hashlib.sha256(self.resourceBody(n)).hexdigest()
+                                               for n in (0, 1, 2, 4)))
+
+        # and next time they are all as they were
+        counts = self.mirror(workers = 1)
+        self.assertEqual(counts["unchanged"], RESOURCES)
+
+if __name__ == '__main__':
+    unittest.main()
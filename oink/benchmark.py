@@ -0,0 +1,53 @@
+# Times how long it takes to render the scheme details pages, comparing the
+# simpleTAL interpreter against the Python code generated from the template.
+#
+#   python3 benchmark.py [settings.ini] [repeats]
+
+import sys, time, logging
+from simpletal import simpleTAL
+from buildschemes import SchemeLibrary
+
+def renderAll(lib, template, interpreter_class, use_generated_code=0):
+    pages = []
+    context = lib.makeContext()
+    for ascheme in lib.getAllocatedSchemes():
+        context.addGlobal('thisascheme', ascheme)
+        output = simpleTAL.OutputBuffer()
+        interpreter = interpreter_class(minimizeBooleanAtts = template.minimizeBooleanAtts)
+        interpreter.useGeneratedCode = use_generated_code
+        interpreter.initialise(context, output)
+        template.expandInline(context, output, interpreter)
+        pages.append(output.getvalue())
+    return pages
+
+def timeRenders(lib, template, interpreter_class, repeats, use_generated_code=0):
+    best = None
+    for attempt in range(3):
+        start = time.perf_counter()
+        for i in range(repeats):
+            renderAll(lib, template, interpreter_class, use_generated_code)
+        taken = time.perf_counter() - start
+        if best is None or taken < best:
+            best = taken
+    return best / (repeats * len(lib.getAllocatedSchemes()))
+
+if __name__ == "__main__":
+    settings = sys.argv[1] if len(sys.argv) > 1 else 'test_config/settings.ini'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    logging.disable(logging.CRITICAL)
+
+    lib = SchemeLibrary(config_ini_path = settings)
+    lib.loadSchemes()
+    template = lib.getTemplate("details.html")
+
+    pages = renderAll(lib, template, simpleTAL.HTMLTemplateInterpreter)
+    if pages != renderAll(lib, template, simpleTAL.HTMLTemplateInterpreter, 1):
+        raise Exception("The generated code rendered different pages!")
+
+    interpreted = timeRenders(lib, template, simpleTAL.HTMLTemplateInterpreter, repeats)
+    generated = timeRenders(lib, template, simpleTAL.HTMLTemplateInterpreter, repeats, 1)
+    print("%d pages, %d commands in details.html" %
+          (len(lib.getAllocatedSchemes()), len(template.commandList)))
+    print("interpreter:    %.3f ms per page" % (interpreted * 1000))
+    print("generated code: %.3f ms per page" % (generated * 1000))
+    print("speed up:       %.2fx" % (interpreted / generated))
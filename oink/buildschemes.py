@@ -1,16 +1,82 @@
-import csv, sys, logging, os, os.path, re, datetime, configparser
-from simpletal import simpleTALES, simpleTAL
+import csv, sys, logging, os, os.path, re, datetime, configparser, argparse
+import hashlib, json, time, operator, pickle
+import concurrent.futures
+import http.server, threading, functools, urllib.parse
+from simpletal import simpleTALES, simpleTALUtils
 
 logging.basicConfig(level = logging.INFO, filename="buildschemes.log")
 loginfo = lambda x: logging.info(x)
-textmatch = lambda x,y: str(x).lower()==str(y).lower()
 
-class UnicodeDictReader(csv.DictReader, object):
-
-    def next(self):
-        row = super(UnicodeDictReader, self).next()
-        return {unicode(key, 'utf-8'):
-                unicode(value, 'utf-8') for key, value in row.iteritems()}
+# where the page templates live, relative to where we run from
+TEMPLATE_FOLDER = "templates"
+
+# the spreadsheets we load from the config folder
+UNITS_CSV = 'SchemeUnits.csv'
+OBJECTIVES_CSV = 'Objectives.csv'
+GROUPS_CSV = 'SetsSchemes.csv'
+HALF_TERMS_CSV = 'HalfTerms.csv'
+ASSESSMENTS_CSV = 'Assessments.csv'
+CONFIG_FILES = (UNITS_CSV, OBJECTIVES_CSV, GROUPS_CSV, HALF_TERMS_CSV, ASSESSMENTS_CSV)
+
+# build records are kept in this folder, next to the settings file rather
+# than in the target folder that gets published; it can be set with
+# cache_folder in the settings
+CACHE_FOLDER = ".cache"
+
+# what went into each page last time, kept in the cache folder
+MANIFEST_NAME = ".buildschemes-manifest.json"
+MANIFEST_VERSION = 1
+
+# the loaded library, saved for the next run to pick up if the config
+# files haven't changed; bump the version whenever the model changes
+SNAPSHOT_NAME = ".buildschemes-snapshot.pickle"
+SNAPSHOT_VERSION = 2
+
+def digest(thing):
+    """Returns a hash of anything that json can write out"""
+    text = json.dumps(thing, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def fileDigest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def writeFileAtomically(path, data):
+    """Writes data (bytes) to a temporary file next to path and moves it
+    into place, so nothing reading the folder sees a half-written file"""
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def readCSV(path, columns):
+    """Yields a tuple of the named columns for each row of the csv file at
+    path.  Positions come from the header row; blank lines are skipped and
+    short rows padded out with empty strings."""
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        try:
+            positions = [header.index(name) for name in columns]
+        except ValueError:
+            raise ValueError("%s needs the columns %s, but has %s" %
+                             (path, ", ".join(columns), ", ".join(header)))
+        width = max(positions) + 1
+        padding = [''] * width
+        pick = operator.itemgetter(*positions)
+        if len(positions) == 1:
+            pick = lambda row, pick = pick: (pick(row),)
+        for row in reader:
+            if len(row) < width:
+                if not row:
+                    continue
+                row = row + padding[len(row):]
+            yield pick(row)
 
 class SchemeLibrary:
 
@@ -32,6 +98,11 @@ class SchemeLibrary:
             config['DEFAULT']['target_folder']
             )
 
+        self.cache_path = os.path.join(
+            base_path,
+            config['DEFAULT'].get('cache_folder', CACHE_FOLDER)
+            )
+
         # we'll put the Scheme objects in here
         self.schemes = {}
 
@@ -41,76 +112,261 @@ class SchemeLibrary:
         # what half-terms are we working with?
         self.half_terms = []
 
-    def loadSchemes(self):
-        # open up the file with all the units for each scheme
-        _units_path = os.path.join(self.config_path, 'SchemeUnits.csv')
-        with open(_units_path, encoding="utf-8") as units_file:
-            for unit_row in UnicodeDictReader(units_file):
-                sid = str(unit_row['scheme_id']).lower()
-                if not sid:
-                    logging.warning("No scheme id found in this row: "+str(unit_row))
-                    continue
-                scheme = self.getScheme(sid)
-                if not scheme:
-                    scheme = Scheme(sid)
-                    self.addScheme(scheme)
-                    logging.info("Just added scheme [%s]" % sid)
-
-                # let's check if such a file exists first
-                fname = unit_row['file']
-                if fname and not os.path.exists(os.path.join(self.output_path, fname)):
-                    logging.warning("Could not find a file at %s" % fname)
-                    fname = None
-                scheme.addUnit(
-                    unit_row['unit_id'],
-                    half_term = int(unit_row['half_term']),
-                    unit_type = unit_row['type'],
-                    title = unit_row['unit_title'],
-                    file_path = fname
-                )
-                logging.info("added unit [%s] to scheme [%s]" % (unit_row['unit_id'],sid))
-        logging.info("After first part of loading, we have " + str(self.schemes) )
-
-        _objectives_path = os.path.join(self.config_path, 'Objectives.csv')
-        with open(_objectives_path, encoding="utf-8") as objectives_file:
-            for o_row in UnicodeDictReader(objectives_file):
-                sid,uid,obj = [o_row[x] for x in ['scheme_id', 'unit_id', 'objective']]
-                if not (sid and uid and obj):
-                    continue
+        # compiled page templates, only recompiled if the file changes,
+        # and saved alongside the templates for the next run to pick up
+        self.templates = simpleTALUtils.TemplateCache(diskCache = 1)
+
+        # { file name : found } for the unit files named in the config
+        self._unit_files = {}
+
+        # for watch mode: what the files looked like when we last loaded
+        # them, and any that still need loading after a failed reload
+        self._watched = {}
+        self._reload_pending = set()
+
+    def __getstate__(self):
+        # the template cache holds a lock, so it stays behind when the
+        # library is sent off to another process
+        state = self.__dict__.copy()
+        del state['templates']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.templates = simpleTALUtils.TemplateCache(diskCache = 1)
+
+    def loadSchemes(self, use_snapshot=False):
+        """Loads everything from the config files.  With use_snapshot, the
+        snapshot saved by an earlier run is used instead if the config
+        files are the same as they were then, and otherwise a new one is
+        saved once they are loaded."""
+        if use_snapshot:
+            sources = self.describeConfigFiles()
+            if self.loadSnapshot(sources):
+                return
+        self.loadUnits()
+        self.loadObjectives()
+        self.loadAssessments()
+        self.loadGroups()
+        self.loadHalfTerms()
+        if use_snapshot:
+            self.saveSnapshot(sources)
+
+    def describeConfigFiles(self):
+        """Returns { name : hash } for the config files, with None for any
+        that are missing"""
+        sources = {}
+        for name in CONFIG_FILES:
+            try:
+                sources[name] = fileDigest(os.path.join(self.config_path, name))
+            except OSError:
+                sources[name] = None
+        return sources
+
+    def loadSnapshot(self, sources=None):
+        """Takes the library from the snapshot in the cache folder, if
+        there is one that was made from the config files as they are now.
+        Returns whether it did."""
+        try:
+            with open(os.path.join(self.cache_path, SNAPSHOT_NAME), 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception:
+            # missing, unreadable or from an incompatible version
+            return False
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            return False
+        if sources is None:
+            sources = self.describeConfigFiles()
+        # going by the contents, so a file that was only touched still matches
+        if snapshot['sources'] != sources:
+            return False
+        # and the unit files have to be where they were
+        unit_files = snapshot['unit_files']
+        found = self.findTargetFiles(unit_files)
+        if any((name in found) != was_found for name, was_found in unit_files.items()):
+            return False
+        self.schemes = snapshot['schemes']
+        self.allocated_schemes = snapshot['allocated_schemes']
+        self.half_terms = snapshot['half_terms']
+        self._unit_files = unit_files
+        logging.info("Loaded %d schemes from the snapshot" % len(self.schemes))
+        return True
+
+    def saveSnapshot(self, sources=None):
+        """Saves the library in the cache folder for loadSnapshot, noting
+        the config files it came from (by default, as they are now)"""
+        snapshot = {
+            'version' : SNAPSHOT_VERSION,
+            'sources' : sources or self.describeConfigFiles(),
+            'unit_files' : self._unit_files,
+            'schemes' : self.schemes,
+            'allocated_schemes' : self.allocated_schemes,
+            'half_terms' : self.half_terms,
+        }
+        try:
+            os.makedirs(self.cache_path, exist_ok=True)
+            writeFileAtomically(os.path.join(self.cache_path, SNAPSHOT_NAME),
+                                pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+            # earlier builds kept it in the target folder
+            old_path = os.path.join(self.output_path, SNAPSHOT_NAME)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        except (OSError, pickle.PicklingError) as e:
+            # not being able to save is no reason to stop
+            logging.warning("Could not save the snapshot: %s" % e)
+
+    def findTargetFiles(self, names):
+        """Returns the set of names that exist under the target folder,
+        going by a single listing of each folder they are in"""
+        listings = {}
+        found = set()
+        for name in names:
+            folder, base = os.path.split(name)
+            if folder not in listings:
+                try:
+                    listings[folder] = set(os.listdir(os.path.join(self.output_path, folder)))
+                except OSError:
+                    listings[folder] = set()
+            # anything not in its listing (named in another case, say, on a
+            # file system that doesn't mind) gets looked for properly
+            if base in listings[folder] or os.path.exists(os.path.join(self.output_path, name)):
+                found.add(name)
+        return found
+
+    def reload(self, changed):
+        """Loads the named config files again, along with anything that
+        depends on them, leaving the rest of the library as it is"""
+        changed = set(changed)
+        if UNITS_CSV in changed or OBJECTIVES_CSV in changed:
+            # objectives and assessments hang off the units, and groups
+            # off the schemes
+            self.loadUnits()
+            self.loadObjectives()
+            changed.update([ASSESSMENTS_CSV, GROUPS_CSV])
+        if ASSESSMENTS_CSV in changed:
+            self.loadAssessments()
+        if GROUPS_CSV in changed:
+            self.loadGroups()
+        if HALF_TERMS_CSV in changed:
+            self.loadHalfTerms()
+
+    def loadUnits(self):
+        self.schemes = {}
+        schemes = self.schemes
+        rows = list(readCSV(os.path.join(self.config_path, UNITS_CSV),
+                            ['scheme_id', 'unit_id', 'half_term', 'type', 'unit_title', 'file']))
+        # one listing of each folder the unit files are in, rather than a
+        # stat per unit
+        names = set(row[5] for row in rows if row[5])
+        found = self.findTargetFiles(names)
+        self._unit_files = dict((name, name in found) for name in names)
+        for sid, uid, half_term, unit_type, title, fname in rows:
+            sid = sid.lower()
+            if not sid:
+                logging.warning("No scheme id found in this row: " +
+                                str([sid, uid, half_term, unit_type, title, fname]))
+                continue
+            scheme = schemes.get(sid)
+            if not scheme:
+                scheme = Scheme(sid)
+                self.addScheme(scheme)
+                logging.info("Just added scheme [%s]" % sid)
+
+            # let's check if such a file exists first
+            if fname and fname not in found:
+                logging.warning("Could not find a file at %s" % fname)
+                fname = None
+            scheme.addUnit(uid, half_term = int(half_term), unit_type = unit_type,
+                           title = title, file_path = fname)
+        logging.info("Loaded %d units into %d schemes" %
+                     (sum(len(s.units) for s in schemes.values()), len(schemes)))
+
+    def loadObjectives(self):
+        # gather each unit's objectives first, so every scheme's store can
+        # be laid out unit by unit in one go
+        gathered = {}
+        skipped = 0
+        last_key = last_list = None
+        rows = readCSV(os.path.join(self.config_path, OBJECTIVES_CSV),
+                       ['scheme_id', 'unit_id', 'objective'])
+        for sid, uid, obj in rows:
+            if not (sid and uid and obj):
+                continue
+            # the rows for a unit usually come together
+            key = (sid, uid)
+            if key != last_key:
+                s = self.schemes.get(sid)
                 # let's not bother if we're not actually building this scheme
-                if not self.getScheme(sid):
-                    logging.debug("Not bothering to add %s, %s, %s" % (sid,uid,obj))
+                if not s:
+                    skipped += 1
                     continue
-                s = self.getScheme(sid.lower())
                 u = s.getUnit(uid.lower())
-                u.appendObjective(obj)
-                logging.debug("Adding objective [%s] to scheme [%s] and unit [%s]" % (obj,sid,uid))
-
-        _groups_path = os.path.join(self.config_path, 'SetsSchemes.csv')
-        with open(_groups_path, encoding="utf-8") as groups_file:
-            for entry in UnicodeDictReader(groups_file):
-                grp,sid = entry['teaching_group'], entry['scheme_id']
-                if not (grp and sid):
+                last_key, last_list = key, gathered.setdefault(u, [])
+            last_list.append(obj)
+        for scheme in self.schemes.values():
+            for unit in scheme.units:
+                if unit in gathered:
+                    unit.extendObjectives(gathered[unit])
+        logging.info("Loaded the objectives of %d units, skipping %d rows for other schemes" %
+                     (len(gathered), skipped))
+
+    def loadAssessments(self):
+        """Gives each unit the questions of its assessment, in the order
+        they come in Assessments.csv.  The file is optional."""
+        # whatever was loaded before goes, even if the file has too
+        for scheme in self.schemes.values():
+            for unit in scheme.units:
+                unit.questions = ()
+        path = os.path.join(self.config_path, ASSESSMENTS_CSV)
+        if not os.path.exists(path):
+            logging.info("No %s, so no assessments" % ASSESSMENTS_CSV)
+            return
+        gathered = {}
+        skipped = 0
+        last_key = last_list = None
+        for sid, uid, q, description, level in readCSV(
+                path, ['scheme_id', 'unit_id', 'q', 'description', 'level']):
+            if not (sid and uid and q):
+                continue
+            # the rows for an assessment usually come together
+            key = (sid, uid)
+            if key != last_key:
+                s = self.schemes.get(sid)
+                u = s and s.findUnit(uid)
+                if not u:
+                    # not a unit of a scheme we're building
+                    skipped += 1
                     continue
-                scheme = self.getScheme(sid)
-                if not scheme:
-                    raise ValueError("Scheme [%s] is not known" % sid)
-                self.allocated_schemes.append( AllocatedScheme(grp,scheme) )
-
-        _ht_path = os.path.join(self.config_path,'HalfTerms.csv')
-        with open(_ht_path, encoding="utf-8") as ht_file:
-            for ht in UnicodeDictReader(ht_file):
-                num = int(ht['half_term'])
-                title = ht['title']
-                long_title = ht['long_title']
-                code = ht['code']
-                weeks = int(ht['weeks'])
-                self.half_terms.append( {
-                    'num':num,
-                    'long_title' : long_title,
-                    'code' : code,
-                    'weeks' : weeks
-                })
+                last_key, last_list = key, gathered.setdefault(u, [])
+            last_list.append(Question(q, description, level))
+        for unit, questions in gathered.items():
+            unit.questions = tuple(questions)
+        logging.info("Loaded the assessments of %d units, skipping %d for other units" %
+                     (len(gathered), skipped))
+
+    def loadGroups(self):
+        self.allocated_schemes = []
+        rows = readCSV(os.path.join(self.config_path, GROUPS_CSV),
+                       ['teaching_group', 'scheme_id'])
+        for grp, sid in rows:
+            if not (grp and sid):
+                continue
+            scheme = self.schemes.get(sid)
+            if not scheme:
+                raise ValueError("Scheme [%s] is not known" % sid)
+            self.allocated_schemes.append( AllocatedScheme(grp,scheme) )
+
+    def loadHalfTerms(self):
+        self.half_terms = []
+        rows = readCSV(os.path.join(self.config_path, HALF_TERMS_CSV),
+                       ['half_term', 'long_title', 'code', 'weeks'])
+        for num, long_title, code, weeks in rows:
+            self.half_terms.append( {
+                'num' : int(num),
+                'long_title' : long_title,
+                'code' : code,
+                'weeks' : int(weeks)
+            })
 
     def addScheme(self, scheme):
         self.schemes[scheme.id] = scheme
@@ -125,61 +381,380 @@ class SchemeLibrary:
     def getAllocatedSchemes(self):
         return self.allocated_schemes
 
-    def writeHTML(self):
+    def getQuestions(self, scheme_id, unit_id):
+        """Returns the questions of a unit's assessment, or nothing if it
+        has none or there's no such unit"""
+        scheme = self.getScheme(scheme_id)
+        unit = scheme and scheme.findUnit(unit_id)
+        return unit.questions if unit else ()
+
+    def getTemplate(self, name):
+        """Returns the compiled template called name from the template folder"""
+        return self.templates.getTemplate(os.path.join(TEMPLATE_FOLDER, name))
+
+    def makeContext(self):
         context = simpleTALES.Context(allowPythonPath = 1)
         context.addGlobal('library', self)
-        template_file = open("templates/index.html", encoding="utf-8")
-        template = simpleTAL.compileHTMLTemplate(template_file)
-        template_file.close()
-        out_file = open(os.path.join(self.output_path, "index.html"), 'w', encoding="utf-8")
-        template.expand(context, out_file, outputEncoding="utf-8")
-        out_file.close()
+        return context
+
+    def writePage(self, template, context, file_name):
+        """Renders the page and writes it to file_name in the target
+        folder, unless the file already holds exactly that page.  Returns
+        file_name if the file was written, otherwise None."""
+        text = template.expand(context, useGeneratedCode=1)
+        # the bytes a text mode file would have got
+        page = text.replace("\n", os.linesep).encode("utf-8")
+        path = os.path.join(self.output_path, file_name)
+        try:
+            if os.path.getsize(path) == len(page):
+                with open(path, 'rb') as f:
+                    if f.read() == page:
+                        return None
+        except OSError:
+            pass
+        writeFileAtomically(path, page)
+        return file_name
+
+    def writeDetailsPage(self, template, context, ascheme):
+        context.addGlobal('thisascheme', ascheme)
+        return self.writePage(template, context, ascheme.getDetailsFileName())
+
+    def getPageNames(self):
+        """Returns the file names of all the pages writeHTML makes"""
+        return ["index.html"] + [a.getDetailsFileName() for a in self.getAllocatedSchemes()]
+
+    def renderPage(self, file_name):
+        """Returns the text of the page that would be written to file_name,
+        or None if it isn't one of ours"""
+        context = self.makeContext()
+        if file_name == "index.html":
+            return self.getTemplate("index.html").expand(context, useGeneratedCode=1)
+        for ascheme in self.getAllocatedSchemes():
+            if ascheme.getDetailsFileName() == file_name:
+                context.addGlobal('thisascheme', ascheme)
+                return self.getTemplate("details.html").expand(context, useGeneratedCode=1)
+        return None
+
+    def readManifest(self):
+        """Returns what the last build recorded, or an empty manifest if
+        there isn't one we can use"""
+        try:
+            with open(os.path.join(self.cache_path, MANIFEST_NAME), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest
+
+    def writeManifest(self, manifest):
+        text = json.dumps(manifest, sort_keys=True, indent=1)
+        os.makedirs(self.cache_path, exist_ok=True)
+        writeFileAtomically(os.path.join(self.cache_path, MANIFEST_NAME), text.encode("utf-8"))
+        # earlier builds kept it in the target folder
+        old_path = os.path.join(self.output_path, MANIFEST_NAME)
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    def makeManifest(self):
+        """Works out a hash of everything that goes into each page"""
+        templates = {}
+        for name in ("index.html", "details.html"):
+            templates[name] = fileDigest(os.path.join(TEMPLATE_FOLDER, name))
+        schemes = {sid: s.getDigest() for sid, s in self.schemes.items()}
+        half_terms = digest(self.half_terms)
+
+        # every page links to every other one, so they all depend on this
+        groups = digest([[a.teaching_group, a.scheme.id, a.getDetailsFileName()]
+                         for a in self.getAllocatedSchemes()])
+
+        pages = {"index.html": digest([templates["index.html"], groups])}
+        for ascheme in self.getAllocatedSchemes():
+            pages[ascheme.getDetailsFileName()] = digest([
+                templates["details.html"], groups, half_terms,
+                ascheme.teaching_group, schemes[ascheme.scheme.id]])
+        return {
+            'version': MANIFEST_VERSION,
+            'templates': templates,
+            'schemes': schemes,
+            'half_terms': half_terms,
+            'pages': pages,
+        }
+
+    def writeHTML(self, jobs=1, force=False):
+        """Writes the index page and a details page for each allocated
+        scheme, skipping any page whose inputs haven't changed since the
+        last build (unless force is set), and leaving alone any file that
+        already holds exactly what was rendered.  With jobs > 1 the details
+        pages are shared out between that many worker processes.  Returns
+        the names of the files written."""
+        manifest = self.makeManifest()
+        old_pages = {} if force else self.readManifest().get('pages', {})
+
+        def isStale(fname):
+            return (old_pages.get(fname) != manifest['pages'][fname] or
+                    not os.path.exists(os.path.join(self.output_path, fname)))
+
+        # the file names written, with None for pages rendered unchanged
+        results = []
+        context = self.makeContext()
+        if isStale("index.html"):
+            results.append(self.writePage(self.getTemplate("index.html"), context, "index.html"))
 
         # make a separate details file for each allocated scheme
-        for ascheme in self.getAllocatedSchemes():
-            context.addGlobal('thisascheme', ascheme)
-            template_file = open("templates/details.html", encoding="utf-8")
-            template = simpleTAL.compileHTMLTemplate(template_file)
-            template_file.close()
-            out_file = open(os.path.join(self.output_path, ascheme.getDetailsFileName()), 'w', encoding="utf-8")
-            template.expand(context, out_file, outputEncoding="utf-8")
-            out_file.close()
+        template = self.getTemplate("details.html")
+        aschemes = self.getAllocatedSchemes()
+        stale = [i for i, a in enumerate(aschemes) if isStale(a.getDetailsFileName())]
+        if jobs <= 1 or len(stale) <= 1:
+            for i in stale:
+                results.append(self.writeDetailsPage(template, context, aschemes[i]))
+        else:
+            # each worker gets its own copy of the library and the compiled
+            # template once, then just gets told which scheme to write
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers = jobs,
+                    initializer = _initPageWorker,
+                    initargs = (self, template)) as pool:
+                chunks = max(1, len(stale) // (jobs * 4))
+                for fname in pool.map(_writeDetailsPage, stale, chunksize = chunks):
+                    logging.info("Worker wrote %s" % fname)
+                    results.append(fname)
+
+        self.writeManifest(manifest)
+        written = [fname for fname in results if fname]
+        logging.info("Wrote %d pages, %d unchanged (%d rendered the same as before)" %
+                     (len(written), len(manifest['pages']) - len(written),
+                      len(results) - len(written)))
+        return written
+
+    def statWatchedFiles(self):
+        """Returns { path : (mtime, size) } for the config files and
+        templates, with None for any that are missing"""
+        paths = [os.path.join(self.config_path, name) for name in CONFIG_FILES]
+        paths += [os.path.join(TEMPLATE_FOLDER, name) for name in
+                  ("index.html", "details.html")]
+        stats = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stats[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stats[path] = None
+        return stats
+
+    def reloadChanged(self):
+        """Reloads whichever config files have changed since the last
+        check.  Returns the paths of the config files and templates that
+        changed."""
+        stats = self.statWatchedFiles()
+        changed = [path for path in stats if stats[path] != self._watched.get(path)]
+        if not changed:
+            return []
+        self._watched = stats
+        # a template edited in the same moment it was compiled could still
+        # look the same to the template cache
+        for path in changed:
+            if os.path.dirname(path) == TEMPLATE_FOLDER:
+                self.templates.evict(path)
+        # anything that failed to load last time gets another go
+        self._reload_pending.update(os.path.basename(path) for path in changed)
+        self.reload(self._reload_pending)
+        self._reload_pending = set()
+        return changed
+
+    def checkForChanges(self, jobs=1):
+        """Reloads whatever has changed since the last check and writes
+        the pages that depend on it.  Returns the names of the files
+        written, or None if nothing had changed."""
+        if not self.reloadChanged():
+            return None
+        # templates are checked by the template cache and the manifest
+        return self.writeHTML(jobs = jobs)
+
+    def watch(self, jobs=1, force=False, interval=0.5):
+        """Keeps the library loaded and rebuilds the pages whenever the
+        config files or templates change, until interrupted"""
+        self._watched = self.statWatchedFiles()
+        self.writeHTML(jobs = jobs, force = force)
+        print("Watching %s for changes, press Ctrl-C to stop" % self.config_path)
+        while True:
+            time.sleep(interval)
+            try:
+                written = self.checkForChanges(jobs = jobs)
+            except Exception as e:
+                logging.exception("Rebuild failed")
+                print("Rebuild failed: %s" % e)
+                continue
+            if written is not None:
+                print("%s: wrote %s" % (datetime.datetime.now().strftime("%H:%M:%S"),
+                                        ", ".join(written) or "nothing"))
+
+    def serve(self, port=8000):
+        """Serves the pages from memory on http://localhost:port/ until
+        interrupted, along with everything else in the target folder"""
+        self._watched = self.statWatchedFiles()
+        server = PreviewServer(self, ("127.0.0.1", port))
+        print("Serving %s on http://localhost:%d/, press Ctrl-C to stop" %
+              (self.config_path, server.server_port))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+class PreviewServer(http.server.ThreadingHTTPServer):
+    """Serves the scheme pages straight from a loaded library, rendering
+    each one when it's first asked for and keeping it until the config
+    files or templates change.  Any other file comes from the target
+    folder, as it would for the built pages, without waiting for the
+    library or looking at the config files."""
+
+    def __init__(self, library, address):
+        handler = functools.partial(PreviewRequestHandler, directory = library.output_path)
+        super().__init__(address, handler)
+        self.library = library
+        # { file name : rendered page as utf-8 }
+        self.pages = {}
+        # why the config files couldn't be loaded, until they can be
+        self.load_error = None
+        # the library and the pages are shared between request threads
+        self.lock = threading.Lock()
+
+    def getPage(self, file_name):
+        """Returns the page as bytes, or None if it isn't one of ours.
+        Raises an exception if the config files fail to load."""
+        with self.lock:
+            try:
+                if self.library.reloadChanged():
+                    self.pages = {}
+                    self.load_error = None
+            except Exception as e:
+                logging.exception("Reloading the config files failed")
+                self.pages = {}
+                self.load_error = e
+            if self.load_error is not None:
+                raise self.load_error
+            page = self.pages.get(file_name)
+            if page is None:
+                text = self.library.renderPage(file_name)
+                if text is None:
+                    return None
+                page = self.pages[file_name] = text.encode("utf-8")
+            return page
+
+class PreviewRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    def do_GET(self):
+        if not self.sendPage(include_body = True):
+            super().do_GET()
+
+    def do_HEAD(self):
+        if not self.sendPage(include_body = False):
+            super().do_HEAD()
+
+    def sendPage(self, include_body):
+        """Sends the rendered page if the request is for one, returning
+        False if it should be served from the folder instead"""
+        file_name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        file_name = file_name or "index.html"
+        if not file_name.endswith(".html"):
+            # stylesheets, scripts and images never depend on the config
+            return False
+        try:
+            page = self.server.getPage(file_name)
+        except Exception as e:
+            self.send_error(500, "Could not build the page", str(e))
+            return True
+        if page is None:
+            return False
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if include_body:
+            self.wfile.write(page)
+        return True
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+# set up in each worker process by _initPageWorker
+_worker_library = None
+_worker_template = None
+_worker_context = None
+
+def _initPageWorker(library, template):
+    global _worker_library, _worker_template, _worker_context
+    _worker_library = library
+    _worker_template = template
+    _worker_context = library.makeContext()
+
+def _writeDetailsPage(index):
+    ascheme = _worker_library.getAllocatedSchemes()[index]
+    return _worker_library.writeDetailsPage(_worker_template, _worker_context, ascheme)
 
 class Scheme:
 
+    __slots__ = ('id', 'units', 'objectives', '_units_by_id', '_units_by_ht')
+
     def __init__(self, id):
 
         # how we refer to this scheme
-        self.id = id
+        self.id = sys.intern(id)
 
-        # the actual units as a dictionary { id : unit object }
+        # the actual units, in the order they were added
         self.units = []
 
+        # the objectives of every unit, one after the other; each unit
+        # knows where its own run of them starts and ends
+        self.objectives = []
+
+        # lookups kept in step with self.units by addUnit:
+        # { lower-cased unit id : unit } and { half term : [units] }
+        self._units_by_id = {}
+        self._units_by_ht = {}
+
+    def findUnit(self, id):
+        """Returns the unit with this id (in any case), or None if there
+        isn't one"""
+        return self._units_by_id.get(str(id).lower())
+
     def getUnit(self, id):
-        matches = [u for u in self.units if textmatch(u.id, id)]
-        if len(matches)==1:
-            return matches[0]
-        elif len(matches)>1:
-            raise ValueError("We have a duplicate unit with id %s!" % str(id))
-        else:
+        unit = self.findUnit(id)
+        if unit is None:
             logging.error("Was looking for unit id [%s]" % str(id))
             for u in self.units:
                 logging.error("I have %s" % u.id)
             raise ValueError("Could not find unit %s!" % str(id))
+        return unit
 
     def getUnitsForHT(self, htnum):
-        matches = [u for u in self.units if u.half_term == htnum]
-        return matches
+        # a copy, so the index can't be changed through it
+        return list(self._units_by_ht.get(htnum, ()))
 
     def addUnit(self, id, title, half_term, unit_type, file_path):
         # check first we don't already have one
-        matches = [u for u in self.units if textmatch(u.id, id)]
-        if len(matches) > 0:
+        key = sys.intern(str(id).lower())
+        if key in self._units_by_id:
             raise ValueError("We already have unit with the id '%s'" % str(id))
-        self.units.append(SchemeUnit(id, title, half_term, unit_type, file_path))
+        unit = SchemeUnit(id, title, half_term, unit_type, file_path,
+                          store = self.objectives)
+        self.units.append(unit)
+        self._units_by_id[key] = unit
+        self._units_by_ht.setdefault(half_term, []).append(unit)
+        return unit
+
+    def getDigest(self):
+        """Returns a hash of all the units and objectives in this scheme"""
+        return digest([self.id] + [
+            [u.id, u.title, u.half_term, u.unit_type, u.file_path, list(u.getObjectives()),
+             [[q.q, q.description, q.level] for q in u.questions]]
+            for u in self.units])
 
 class AllocatedScheme:
 
+    __slots__ = ('scheme', 'teaching_group')
+
     def __init__(self, teaching_group = None, scheme = None):
         self.scheme = scheme
         self.teaching_group = teaching_group
@@ -192,32 +767,118 @@ class AllocatedScheme:
 
 class SchemeUnit:
 
+    __slots__ = ('id', 'title', 'half_term', 'unit_type', 'file_path',
+                 'questions', '_store', '_start', '_end')
+
     def __init__(self, id, title='', half_term = 0, unit_type='', file_path='',
-                 objectives=[]):
-        self.id = id
+                 objectives=(), store=None):
+        self.id = sys.intern(str(id))
         self.title = title
         self.half_term = half_term
         self.unit_type = unit_type
         self.file_path = file_path
 
-        # the main thing
-        self._objectives = objectives[:]
+        # for assessments, the questions on the paper
+        self.questions = ()
 
-        # we'll try to look for resources related to each unit to list
-        # on the scheme details page
-        self.resource_links = []
+        # the main thing: our objectives are store[_start:_end], where the
+        # store is shared with the other units of the scheme
+        self._store = [] if store is None else store
+        self._start = len(self._store)
+        self._store.extend(objectives)
+        self._end = len(self._store)
 
     def appendObjective(self, obj):
-        self._objectives.append(obj)
-        logging.debug("Just added [%s] to %s.  Length is now %d" % (obj,self.id,len(self._objectives)))
+        self.extendObjectives([obj])
+
+    def extendObjectives(self, objs):
+        if self._end != len(self._store):
+            # another unit has added objectives after ours since, so ours
+            # carry on from a copy at the end of the store
+            start = len(self._store)
+            self._store.extend(self._store[self._start:self._end])
+            self._start = start
+        self._store.extend(objs)
+        self._end = len(self._store)
 
     def getObjectives(self):
-        logging.debug("reporting back [%s], [%d]" % (self.id, len(self._objectives)))
-        return self._objectives[:]
+        """Returns a read-only view of the objectives.  The store is only
+        ever added to, so the view keeps showing what was there when it was
+        made."""
+        return ObjectiveView(self._store, self._start, self._end)
+
+class Question:
+    """One question of a unit's assessment, for the question grids"""
+
+    __slots__ = ('q', 'description', 'level')
+
+    def __init__(self, q, description='', level=''):
+        self.q = q
+        self.description = description
+        self.level = level
+
+class ObjectiveView:
+    """A read-only sequence of some of the objectives in a scheme's store"""
+
+    __slots__ = ('_store', '_start', '_end')
+
+    def __init__(self, store, start, end):
+        self._store = store
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("objective index out of range")
+        return self._store[self._start + index]
+
+    def __iter__(self):
+        store = self._store
+        for i in range(self._start, self._end):
+            yield store[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (ObjectiveView, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return "ObjectiveView(%r)" % list(self)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        raise Exception("I was expecting just one argument with the path of the settings file")
-    lib = SchemeLibrary(config_ini_path = sys.argv[1])
-    lib.loadSchemes()
-    lib.writeHTML()
+    parser = argparse.ArgumentParser(description = "Build the scheme of work pages")
+    parser.add_argument("settings", help = "path of the settings file")
+    parser.add_argument("--jobs", "-j", type = int, default = 1,
+                        help = "number of processes to write the scheme pages with")
+    parser.add_argument("--force", "-f", action = "store_true",
+                        help = "write every page, even if nothing has changed")
+    parser.add_argument("--watch", "-w", action = "store_true",
+                        help = "keep running, rebuilding when the config or templates change")
+    parser.add_argument("--no-snapshot", action = "store_true",
+                        help = "read the config files even if the snapshot of them is up to date")
+    parser.add_argument("--serve", "-s", type = int, nargs = "?", const = 8000, metavar = "PORT",
+                        help = "preview the pages on http://localhost:PORT/ without writing them")
+    args = parser.parse_args()
+    lib = SchemeLibrary(config_ini_path = args.settings)
+    lib.loadSchemes(use_snapshot = not args.no_snapshot)
+    if args.serve is not None:
+        try:
+            lib.serve(port = args.serve)
+        except KeyboardInterrupt:
+            pass
+    elif args.watch:
+        try:
+            lib.watch(jobs = args.jobs, force = args.force)
+        except KeyboardInterrupt:
+            pass
+    else:
+        written = lib.writeHTML(jobs = args.jobs, force = args.force)
+        print("Wrote %d pages, %d unchanged" %
+              (len(written), len(lib.getPageNames()) - len(written)))
@@ -73,6 +73,9 @@ TAL_NAME_URI="http://xml.zope.org/namespaces/tal"
 # All commands are of the form (opcode, args, commandList)
 # The numbers are the opcodes, and also the order of priority
 
+# Expressions in the arguments below are simpleTALES.Expression objects,
+# parsed once when the template is compiled.
+
 # Argument: [(isLocalFlag (Y/n), variableName, variablePath),...]
 TAL_DEFINE = 1
 # Argument: expression, endTagSymbol
@@ -91,9 +94,11 @@ TAL_OMITTAG = 7
 TAL_START_SCOPE = 8
 # Argument: String to output
 TAL_OUTPUT = 9
-# Argument: None
+# Argument: tagName, singletonFlag, staticTag
+#   staticTag is (startTagText, singletonTagText) when no tal:attributes can
+#   change the tag, otherwise None and the tag is built when it is output.
 TAL_STARTTAG = 10
-# Argument: Tag, omitTagFlag
+# Argument: tagName, omitTagFlag, singletonFlag, endTagText
 TAL_ENDTAG_ENDSCOPE = 11
 # Argument: None
 TAL_NOOP = 13
@@ -107,6 +112,10 @@ METAL_DEFINE_SLOT=15
 METAL_FILL_SLOT=16
 METAL_DEFINE_MACRO=17
 											
+# Bump this whenever the layout of the compiled commands changes, so that
+# any compiled templates saved to disk by an older version are ignored.
+PROGRAM_FORMAT_VERSION = 3
+
 METAL_NAME_REGEX = re.compile ("[a-zA-Z_][a-zA-Z0-9_]*")
 SINGLETON_XML_REGEX = re.compile ('^<[^\s/>]+(?:\s*[^=>]+="[^">]+")*\s*/>')
 SINGLETON_BYTES_XML_REGEX = re.compile (b'^<[^\s/>]+(?:\s*[^=>]+="[^">]+")*\s*/>')
@@ -147,6 +156,8 @@ class TemplateInterpreter:
 		self.commandHandler [METAL_USE_MACRO] = self.cmdUseMacro
 		self.commandHandler [METAL_DEFINE_SLOT] = self.cmdDefineSlot
 		self.commandHandler [TAL_NOOP] = self.cmdNoOp
+		# Run the Python generated for each template rather than its commands
+		self.useGeneratedCode = 0
 		
 	def tagAsText (self, tagObj, singletonFlag=0):
 		""" This returns a tag as text.
@@ -169,6 +180,11 @@ class TemplateInterpreter:
 	def initialise (self, context, outputFile):
 		self.context = context
 		self.file = outputFile
+		# An OutputBuffer is given the chance to pass its output on at the end of each element
+		if (isinstance (outputFile, OutputBuffer)):
+			self.outputBuffer = outputFile
+		else:
+			self.outputBuffer = None
 		
 	def cleanState (self):
 		self.scopeStack = []
@@ -208,7 +224,22 @@ class TemplateInterpreter:
 				,self.localVarsDefined)
 		self.programStack.append ((vars,self.commandList, self.symbolTable))
 
+	def hasStandardHandlers (self):
+		""" Returns true if all commands are run by TemplateInterpreter's own methods,
+			which the code generated by TemplateCodeGenerator stands in for.
+		"""
+		for opcode, handler in self.commandHandler.items():
+			if (getattr (handler, '__func__', None) is not STANDARD_COMMAND_HANDLERS.get (opcode)):
+				return 0
+		return 1
+		
 	def execute (self, template):
+		if (self.useGeneratedCode and self.hasStandardHandlers()):
+			program = template.getGeneratedProgram()
+			if (program is not None):
+				self.cleanState()
+				program (self)
+				return
 		self.cleanState()
 		self.commandList, self.programCounter, programLength, self.symbolTable = template.getProgram()
 		cmndList = self.commandList
@@ -216,7 +247,45 @@ class TemplateInterpreter:
 			cmnd = cmndList [self.programCounter]
 			#print "PC: %s  -  Executing command: %s" % (str (self.programCounter), str (cmnd))
 			self.commandHandler[cmnd[0]] (cmnd[0], cmnd[1])
-	
+		
+	def iterExecute (self, template):
+		""" Runs the template like execute, but as a generator that yields the output
+			whenever the OutputBuffer fills at the end of an element.  Templates used as
+			content (macros and slots) are run in this loop rather than by a nested
+			execute, so that their output is streamed too.
+		"""
+		outputBuffer = self.outputBuffer
+		handlers = self.commandHandler
+		inlineTemplates = (getattr (handlers [TAL_ENDTAG_ENDSCOPE], '__func__', None) is TemplateInterpreter.cmdEndTagEndScope)
+		# The end of the program for each template we are part way through
+		programEnds = []
+		self.cleanState()
+		self.commandList, self.programCounter, programLength, self.symbolTable = template.getProgram()
+		while 1:
+			while (self.programCounter < programLength):
+				opcode, args = self.commandList [self.programCounter]
+				if (opcode == TAL_ENDTAG_ENDSCOPE and inlineTemplates and self.tagContent is not None
+						and self.tagContent[0] and isinstance (self.tagContent[1], Template)):
+					# Save our state and start on the other template, as cmdEndTagEndScope would
+					programEnds.append (programLength)
+					resultVal = self.tagContent[1]
+					self.pushProgram()
+					self.cleanState()
+					self.commandList, self.programCounter, programLength, self.symbolTable = resultVal.getProgram()
+					continue
+				handlers [opcode] (opcode, args)
+				if (opcode == TAL_ENDTAG_ENDSCOPE and len (outputBuffer) >= outputBuffer.flushFragments):
+					yield outputBuffer.takeValue()
+			if (len (programEnds) == 0):
+				return
+			# Back to the element that the template was the content of
+			programLength = programEnds.pop()
+			self.popProgram()
+			self.slotParameters = {}
+			self.closeElement (self.commandList [self.programCounter][1])
+			if (len (outputBuffer) >= outputBuffer.flushFragments):
+				yield outputBuffer.takeValue()
+		
 	def cmdDefine (self, command, args):
 		""" args: [(isLocalFlag (Y/n), variableName, variablePath),...]
 				Define variables in either the local or global context
@@ -412,10 +481,13 @@ class TemplateInterpreter:
 		self.programCounter += 1
 		
 	def cmdOutputStartTag (self, command, args):
-		# Args: tagName
-		tagName, singletonTag = args
+		# Args: tagName, singletonFlag, staticTag
+		tagName, singletonTag, staticTag = args
 		if (self.outputTag):
-			if (self.tagContent is None and singletonTag):
+			if (staticTag is not None):
+				# Rendered when the template was compiled
+				self.file.write (staticTag [self.tagContent is None and singletonTag])
+			elif (self.tagContent is None and singletonTag):
 				self.file.write (self.tagAsText ((tagName, self.currentAttributes), 1))
 			else:
 				self.file.write (self.tagAsText ((tagName, self.currentAttributes)))
@@ -462,12 +534,21 @@ class TemplateInterpreter:
 					# THIS IS NOT A BUG!
 					# Use Unicode in the Context object if you are not using Ascii
 					self.file.write (html.escape (str (resultVal), quote=False))
-					
+		self.closeElement (args)
+		
+	def closeElement (self, args):
+		""" Finishes cmdEndTagEndScope once any content has been written: outputs the
+			end tag and goes back round a repeat or ends the scope.
+		"""
 		if (self.outputTag and not args[1]):
 			# Do NOT output end tag if a singleton with no content
 			if not (args[2] and self.tagContent is None):
-				self.file.write ('</' + args[0] + '>')
+				self.file.write (args[3])
 		
+		outputBuffer = self.outputBuffer
+		if (outputBuffer is not None and len (outputBuffer) >= outputBuffer.flushFragments):
+			outputBuffer.flush()
+			
 		if (self.movePCBack is not None):
 			self.programCounter = self.movePCBack
 			return
@@ -553,6 +634,9 @@ class TemplateInterpreter:
 		return
 	
 
+# The method run for each opcode by an unmodified TemplateInterpreter
+STANDARD_COMMAND_HANDLERS = dict ((opcode, handler.__func__) for opcode, handler in TemplateInterpreter().commandHandler.items())
+
 class HTMLTemplateInterpreter (TemplateInterpreter):
 	def __init__ (self, minimizeBooleanAtts = 0):
 		TemplateInterpreter.__init__ (self)
@@ -585,6 +669,40 @@ class HTMLTemplateInterpreter (TemplateInterpreter):
 			result.append (">")
 		return "".join (result)
 	
+# How many pieces of output an OutputBuffer collects before passing them on
+OUTPUT_BUFFER_FRAGMENTS = 4096
+
+class OutputBuffer (list):
+	""" Collects the pieces of text written while a template is expanded and passes
+		them on to the real output file in large blocks.  With no output file
+		everything is kept, and getvalue() returns the whole document.
+	"""
+	# Writing is just appending to the list, so costs no more than a C call.
+	write = list.append
+	
+	def __init__ (self, outputFile=None, flushFragments=OUTPUT_BUFFER_FRAGMENTS):
+		list.__init__ (self)
+		self.outputFile = outputFile
+		self.flushFragments = flushFragments
+		
+	def flushIfFull (self):
+		if (self.outputFile is not None and len (self) >= self.flushFragments):
+			self.flush()
+			
+	def flush (self):
+		if (self.outputFile is not None and len (self) > 0):
+			self.outputFile.write ("".join (self))
+			del self[:]
+			
+	def getvalue (self):
+		return "".join (self)
+		
+	def takeValue (self):
+		""" Returns everything collected so far and empties the buffer """
+		value = "".join (self)
+		del self[:]
+		return value
+		
 class Template:
 	def __init__ (self, commands, macros, symbols, doctype = None):
 		self.commandList = commands
@@ -592,6 +710,9 @@ class Template:
 		self.symbolTable = symbols
 		self.doctype = doctype
 		self.log = logging.getLogger("simpleTAL.Template")
+		# The function generated from the program when first needed, or False
+		# if the program can only be interpreted.
+		self.generatedProgram = None
 		
 		# Setup the macros
 		for macro in list(self.macros.values()):
@@ -604,20 +725,86 @@ class Template:
 				slotMap = arg[1]
 				for slot in list(slotMap.values()):
 					slot.setParentTemplate (self)
+		
+	def __getstate__ (self):
+		# Loggers are looked up again by name rather than pickled.
+		state = self.__dict__.copy()
+		del state ['log']
+		# Generated code is made again when needed, functions can't be pickled.
+		state ['generatedProgram'] = None
+		return state
+		
+	def __setstate__ (self, state):
+		self.__dict__.update (state)
+		self.log = logging.getLogger("simpleTAL.Template")
+		self.generatedProgram = None
 
-	def expand (self, context, outputFile, outputEncoding=None, interpreter=None):
+	def expand (self, context, outputFile=None, outputEncoding=None, interpreter=None, useGeneratedCode=0):
 		""" This method will write to the outputFile, using the encoding specified,
 			the expanded version of this template.  The context passed in is used to resolve
-			all expressions with the template.
+			all expressions with the template.  If no outputFile is given then the
+			expanded template is returned as a string instead.
+			
+			If useGeneratedCode is set the template is compiled to Python the first time
+			and that is run, rather than having the interpreter step through its commands.
 		"""
 		# This method must wrap outputFile if required by the encoding, and write out
 		# any template pre-amble (DTD, Encoding, etc)
-		self.expandInline (context, outputFile, interpreter)
+		return self.expandBuffered (context, outputFile, interpreter, useGeneratedCode=useGeneratedCode)
+		
+	def expandToBytes (self, context, outputEncoding="utf-8", **expandArgs):
+		""" Returns the expanded template encoded as bytes, with any characters the
+			encoding can't represent written as character references.
+		"""
+		result = self.expand (context, None, outputEncoding=outputEncoding, **expandArgs)
+		return result.encode (outputEncoding, 'xmlcharrefreplace')
 		
-	def expandInline (self, context, outputFile, interpreter=None):
-		""" Internally used when expanding a template that is part of a context."""
+	def expandBuffered (self, context, outputFile, interpreter=None, preamble=(), useGeneratedCode=0):
+		""" Expands the template through an OutputBuffer, so that outputFile gets a few
+			large writes.  Returns the expanded template as a string if outputFile is None.
+		"""
+		output = OutputBuffer (outputFile)
+		for text in preamble:
+			output.write (text)
+		try:
+			self.expandInline (context, output, interpreter, useGeneratedCode)
+		finally:
+			output.flush()
+		if (outputFile is None):
+			return output.getvalue()
+		
+	def iterExpand (self, context, interpreter=None, flushFragments=OUTPUT_BUFFER_FRAGMENTS, preamble=()):
+		""" A generator that expands the template, yielding the output as strings a
+			piece at a time (roughly every flushFragments writes) so that the whole
+			document is never held in memory.  Closing the generator stops the expansion.
+		"""
+		output = OutputBuffer (None, flushFragments)
+		for text in preamble:
+			output.write (text)
+		if (interpreter is None):
+			interpreter = self.createInterpreter()
+		interpreter.initialise (context, output)
+		try:
+			for text in interpreter.iterExecute (self):
+				yield text
+		except UnicodeError as unierror:
+			self.log.error ("UnicodeError caused by placing a non-Unicode string in the Context object.")
+			raise simpleTALES.ContextContentException ("Found non-unicode string in Context!")
+		if (len (output) > 0):
+			yield output.takeValue()
+		
+	def createInterpreter (self):
+		""" Returns a new interpreter of the kind used to expand this template """
+		return TemplateInterpreter()
+		
+	def expandInline (self, context, outputFile, interpreter=None, useGeneratedCode=0):
+		""" Internally used when expanding a template that is part of a context.
+			useGeneratedCode only applies to the interpreter created here, one that is
+			passed in keeps its own setting.
+		"""
 		if (interpreter is None):
-			ourInterpreter = TemplateInterpreter()
+			ourInterpreter = self.createInterpreter()
+			ourInterpreter.useGeneratedCode = useGeneratedCode
 			ourInterpreter.initialise (context, outputFile)
 		else:
 			ourInterpreter = interpreter
@@ -631,6 +818,20 @@ class Template:
 		""" Returns a tuple of (commandList, startPoint, endPoint, symbolTable) """
 		return (self.commandList, 0, len (self.commandList), self.symbolTable)
 		
+	def getGeneratedProgram (self):
+		""" Returns the Python function generated from this template's program, making
+			it the first time, or None if the program has to be interpreted.
+		"""
+		if (self.generatedProgram is None):
+			try:
+				self.generatedProgram = TemplateCodeGenerator (self).getProgram()
+			except (CodeGenerationException, SyntaxError, RecursionError, MemoryError) as e:
+				self.log.debug ("No code generated, the template will be interpreted: %s" % str (e))
+				self.generatedProgram = False
+		if (self.generatedProgram is False):
+			return None
+		return self.generatedProgram
+		
 	def __str__ (self):
 		result = "Commands:\n"
 		index = 0
@@ -688,25 +889,24 @@ class HTMLTemplate (Template):
 		self.minimizeBooleanAtts = minimizeBooleanAtts
 		Template.__init__ (self, commands, macros, symbols, doctype = None)
 	
-	def expand (self, context, outputFile, outputEncoding = "utf-8", interpreter=None):
+	def expand (self, context, outputFile=None, outputEncoding = "utf-8", interpreter=None, useGeneratedCode=0):
 		""" This method will write to the outputFile the expanded version of this template.
 			The context passed in is used to resolve all expressions with the template.
+			If no outputFile is given then the expanded template is returned as a string.
+			If useGeneratedCode is set the template is run as Python generated from it.
 		"""
-		if (isinstance (outputFile, io.TextIOBase) or isinstance (outputFile, codecs.StreamWriter)):
+		if (outputFile is None):
+			self.log.debug ("No output file - returning the expanded template")
+		elif (isinstance (outputFile, io.TextIOBase) or isinstance (outputFile, codecs.StreamWriter)):
 			self.log.debug ("Text based output file detected")
 		else:
 			self.log.debug ("Bytes based output file detected - wrapping in codec for %s", outputEncoding)
 			outputFile = codecs.lookup (outputEncoding).streamwriter (outputFile, 'xmlcharrefreplace')
-		self.expandInline (context, outputFile, interpreter)
+		return self.expandBuffered (context, outputFile, interpreter, useGeneratedCode=useGeneratedCode)
 		
-	def expandInline (self, context, outputFile, interpreter=None):
+	def createInterpreter (self):
 		""" Ensure we use the HTMLTemplateInterpreter"""
-		if (interpreter is None):
-			ourInterpreter = HTMLTemplateInterpreter(minimizeBooleanAtts = self.minimizeBooleanAtts)
-			ourInterpreter.initialise (context, outputFile)
-		else:
-			ourInterpreter = interpreter
-		Template.expandInline (self, context, outputFile, ourInterpreter)
+		return HTMLTemplateInterpreter(minimizeBooleanAtts = self.minimizeBooleanAtts)
 		
 class XMLTemplate (Template):
 	"""A specialised form of a template that knows how to output XML
@@ -716,29 +916,508 @@ class XMLTemplate (Template):
 		Template.__init__ (self, commands, macros, symbols)
 		self.doctype = doctype
 	
-	def expand (self, context, outputFile, outputEncoding = "utf-8", docType=None, suppressXMLDeclaration=False,interpreter=None):
+	def expand (self, context, outputFile=None, outputEncoding = "utf-8", docType=None, suppressXMLDeclaration=False,interpreter=None,useGeneratedCode=0):
 		""" This method will write to the outputFile, using the encoding attached to the outputFile,
 			the expanded version of this template.  The context passed in is used to resolve
-			all expressions with the template.
+			all expressions with the template.  If no outputFile is given then the
+			expanded template is returned as a string.  If useGeneratedCode is set the
+			template is run as Python generated from it.
 		"""
-		if (isinstance (outputFile, io.TextIOBase) or isinstance (outputFile, codecs.StreamWriter)):
+		if (outputFile is None):
+			self.log.debug ("No output file - returning the expanded template")
+		elif (isinstance (outputFile, io.TextIOBase) or isinstance (outputFile, codecs.StreamWriter)):
 			self.log.debug ("Text based output file detected")
 		else:
 			self.log.debug ("Bytes based output file detected - wrapping in codec for %s", outputEncoding)
 			outputFile = codecs.lookup (outputEncoding).streamwriter (outputFile, 'xmlcharrefreplace')
-
+		preamble = self.getPreamble (outputEncoding, docType, suppressXMLDeclaration)
+		return self.expandBuffered (context, outputFile, interpreter, preamble, useGeneratedCode)
+		
+	def iterExpand (self, context, outputEncoding = "utf-8", docType=None, suppressXMLDeclaration=False, interpreter=None, flushFragments=OUTPUT_BUFFER_FRAGMENTS):
+		""" A generator that yields the expanded template a piece at a time, starting with
+			the XML declaration and DOCTYPE.  The pieces are strings, outputEncoding is only
+			used in the declaration.
+		"""
+		preamble = self.getPreamble (outputEncoding, docType, suppressXMLDeclaration)
+		return Template.iterExpand (self, context, interpreter, flushFragments, preamble)
+		
+	def getPreamble (self, outputEncoding, docType, suppressXMLDeclaration):
+		""" Returns the XML declaration and DOCTYPE to write before the template """
+		preamble = []
 		if (not suppressXMLDeclaration):
 			if (outputEncoding.lower() != "utf-8"):
-				outputFile.write ('<?xml version="1.0" encoding="%s"?>\n' % outputEncoding.lower())
+				preamble.append ('<?xml version="1.0" encoding="%s"?>\n' % outputEncoding.lower())
 			else:
-				outputFile.write ('<?xml version="1.0"?>\n')
+				preamble.append ('<?xml version="1.0"?>\n')
 		if not docType and self.doctype:
 			docType = self.doctype
 		if docType:
-			outputFile.write (docType)
-			outputFile.write ('\n')
-		self.expandInline (context, outputFile, interpreter)
+			preamble.append (docType)
+			preamble.append ('\n')
+		return preamble
 	
+class CodeGenerationException (Exception):
+	""" Raised when a program has a shape that TemplateCodeGenerator does not handle.
+		Templates that can't be turned into Python are left to the interpreter.
+	"""
+	pass
+
+# Returned by startRepeat when the element and its contents are not output at all.
+NOTHING_TO_REPEAT = ()
+
+# The commands that can appear on a TAL element before its start tag.
+ELEMENT_COMMANDS = (TAL_DEFINE, TAL_CONDITION, TAL_REPEAT, TAL_CONTENT, TAL_ATTRIBUTES
+					,TAL_OMITTAG, TAL_NOOP, METAL_USE_MACRO, METAL_DEFINE_SLOT)
+
+# The position of the end tag symbol in the arguments of the commands that jump to it.
+END_TAG_SYMBOL_ARG = {TAL_CONDITION: 1, TAL_REPEAT: 2, TAL_CONTENT: 3, METAL_USE_MACRO: 2, METAL_DEFINE_SLOT: 1}
+
+def isConditionTrue (result):
+	""" Used by generated code, the test made by TemplateInterpreter.cmdCondition """
+	conditionFalse = 0
+	if (result is None):
+		conditionFalse = 1
+	else:
+		if (not result): conditionFalse = 1
+		try:
+			temp = len (result)
+			if (temp == 0): conditionFalse = 1
+		except:
+			# Result is not a sequence.
+			pass
+	return not conditionFalse
+
+def startRepeat (context, varName, result):
+	""" Used by generated code, sets up a tal:repeat the way TemplateInterpreter.cmdRepeat does.
+		Returns the RepeatVariable, None if the result is the default (the element is output
+		once as it is) or NOTHING_TO_REPEAT.
+	"""
+	if (result is not None and result == simpleTALES.DEFAULTVALUE):
+		return None
+	try:
+		isSequence = len (result)
+		if (isSequence):
+			repeatVariable = simpleTALES.RepeatVariable (result)
+		else:
+			return NOTHING_TO_REPEAT
+	except:
+		if (hasattr (result, "__iter__") and hasattr (result.__iter__, "__call__")):
+			repeatVariable = simpleTALES.IteratorRepeatVariable (result.__iter__())
+		elif (hasattr (result, "__next__") and hasattr (result.__next__, "__call__")):
+			repeatVariable = simpleTALES.IteratorRepeatVariable (result)
+		else:
+			return NOTHING_TO_REPEAT
+	try:
+		curValue = repeatVariable.getCurrentValue()
+	except IndexError as e:
+		# The iterator ran out of values before we started - treat as an empty list
+		return NOTHING_TO_REPEAT
+	context.addRepeat (varName, repeatVariable, curValue)
+	return repeatVariable
+
+def evaluateAttributes (context, originalAttributes, attributeArgs, currentAttributes):
+	""" Used by generated code, returns the attributes left by TemplateInterpreter.cmdAttributes """
+	attsToRemove = {}
+	newAtts = []
+	for attName, attExpr in attributeArgs:
+		resultVal = context.evaluate (attExpr, originalAttributes)
+		if (resultVal is None):
+			attsToRemove [attName]=1
+		elif (not resultVal == simpleTALES.DEFAULTVALUE):
+			attsToRemove [attName]=1
+			newAtts.append ((attName, contentAsText (resultVal)))
+	for oldAttName, oldAttValue in currentAttributes:
+		if (not oldAttName in attsToRemove):
+			newAtts.append ((oldAttName, oldAttValue))
+	return newAtts
+
+def contentAsText (value):
+	""" Used by generated code, the text written for a structure value """
+	if (isinstance (value, str)):
+		return value
+	if (isinstance (value, bytes)):
+		# THIS IS NOT A BUG!
+		# Use Unicode in the Context object if you are not using Ascii
+		return str (value, 'ascii')
+	return str (value)
+
+def escapedContent (value):
+	""" Used by generated code, the text written for a text value """
+	return html.escape (contentAsText (value), quote=False)
+
+class ProgramElement:
+	""" A TAL element in a program: the commands on its start tag, the start tag, the
+		parts of the program between it and the end tag, and the end tag.
+	"""
+	__slots__ = ('scopeArgs', 'commands', 'startTagArgs', 'body', 'endTagArgs', 'endPoint')
+
+	def __init__ (self, scopeArgs):
+		self.scopeArgs = scopeArgs
+		self.commands = []
+		self.startTagArgs = None
+		self.body = []
+		self.endTagArgs = None
+		self.endPoint = None
+
+class TemplateCodeGenerator:
+	""" Turns the program of a template into the source of a Python function that writes
+		the same output TemplateInterpreter.execute would.  tal:repeat becomes a loop,
+		tal:condition an if statement and text that never changes is written as a literal.
+
+		The function is called with the interpreter in place of execute, and uses it for
+		the context, output file and any templates expanded as content.
+	"""
+	def __init__ (self, template):
+		self.commandList, self.startPoint, self.endPoint, self.symbolTable = template.getProgram()
+		self.lines = []
+		self.indent = 1
+		self.constants = []
+		self.constantNames = {}
+		self.elementCount = 0
+
+	def getSource (self):
+		""" Returns the source of the function, which is called expandProgram """
+		nodes = self.parseProgram (self.startPoint, self.endPoint)
+		self.lines = []
+		self.indent = 1
+		self.generateNodes (nodes)
+		prologue = ["def expandProgram (interpreter):"
+					,"\tcontext = interpreter.context"
+					,"\tevaluate = context.evaluate"
+					,"\toutputFile = interpreter.file"
+					,"\twrite = outputFile.write"
+					,"\ttagAsText = interpreter.tagAsText"
+					,"\tslotParameters = interpreter.slotParameters"
+					,"\tcurrentSlots = slotParameters"
+					,"\toutputBuffer = interpreter.outputBuffer"
+					,"\tif (outputBuffer is None):"
+					,"\t\toutputBuffer = ()"
+					,"\t\tflushFragments = 1"
+					,"\telse:"
+					,"\t\tflushFragments = outputBuffer.flushFragments"]
+		if (len (self.constants) > 0):
+			prologue.append ("\t%s, = CONSTANTS" % ", ".join (self.constantNames [id (value)] for value in self.constants))
+		epilogue = ["\tinterpreter.slotParameters = slotParameters", ""]
+		return "\n".join (prologue + self.lines + epilogue)
+
+	def getProgram (self):
+		""" Returns the generated function, compiled and ready to be called with an interpreter """
+		source = self.getSource()
+		namespace = {'CONSTANTS': tuple (self.constants)
+					,'DEFAULTVALUE': simpleTALES.DEFAULTVALUE
+					,'NOTHING_TO_REPEAT': NOTHING_TO_REPEAT
+					,'Template': Template
+					,'SubTemplate': SubTemplate
+					,'isConditionTrue': isConditionTrue
+					,'startRepeat': startRepeat
+					,'evaluateAttributes': evaluateAttributes
+					,'contentAsText': contentAsText
+					,'escapedContent': escapedContent}
+		exec (compile (source, "<simpleTAL generated program>", "exec"), namespace)
+		return namespace ['expandProgram']
+
+	def parseProgram (self, start, end):
+		""" Returns the program from start to end as a list of text to output and ProgramElements """
+		nodes = []
+		pc = start
+		while (pc < end):
+			opcode, args = self.commandList [pc]
+			if (opcode == TAL_OUTPUT):
+				nodes.append (args)
+				pc += 1
+			elif (opcode == TAL_NOOP):
+				pc += 1
+			elif (opcode == TAL_START_SCOPE):
+				element = self.parseElement (pc, end)
+				nodes.append (element)
+				pc = element.endPoint + 1
+			else:
+				raise CodeGenerationException ("Command %s found outside of an element at %s" % (str (opcode), str (pc)))
+		return nodes
+
+	def parseElement (self, pc, end):
+		element = ProgramElement (self.commandList [pc][1])
+		pc += 1
+		while (pc < end and self.commandList [pc][0] != TAL_STARTTAG):
+			if (self.commandList [pc][0] not in ELEMENT_COMMANDS):
+				raise CodeGenerationException ("Command %s found before a start tag at %s" % (str (self.commandList [pc][0]), str (pc)))
+			element.commands.append (self.commandList [pc])
+			pc += 1
+		if (pc >= end):
+			raise CodeGenerationException ("Element has no start tag")
+		element.startTagArgs = self.commandList [pc][1]
+		bodyStart = pc + 1
+		# Find the end tag that matches this element
+		depth = 0
+		pc = bodyStart
+		while (pc < end):
+			opcode = self.commandList [pc][0]
+			if (opcode == TAL_START_SCOPE):
+				depth += 1
+			elif (opcode == TAL_ENDTAG_ENDSCOPE):
+				if (depth == 0):
+					break
+				depth -= 1
+			pc += 1
+		if (pc >= end):
+			raise CodeGenerationException ("Element has no end tag")
+		element.endPoint = pc
+		element.endTagArgs = self.commandList [pc][1]
+		element.body = self.parseProgram (bodyStart, pc)
+		self.checkElement (element)
+		return element
+
+	def checkElement (self, element):
+		""" The generated code follows the order the compiler puts commands in, so
+			anything else is left to the interpreter.
+		"""
+		opcodes = [opcode for opcode, args in element.commands]
+		for opcode, args in element.commands:
+			if (opcode in END_TAG_SYMBOL_ARG and self.symbolTable.get (args [END_TAG_SYMBOL_ARG [opcode]]) != element.endPoint):
+				raise CodeGenerationException ("Command %s does not jump to the end of its element" % str (opcode))
+		if (opcodes.count (TAL_REPEAT) > 1 or opcodes.count (TAL_DEFINE) > 1):
+			raise CodeGenerationException ("Element has more than one repeat or define")
+		if (TAL_REPEAT in opcodes):
+			repeatIndex = opcodes.index (TAL_REPEAT)
+			for opcode in opcodes [:repeatIndex]:
+				if (opcode in (TAL_CONTENT, TAL_ATTRIBUTES, TAL_OMITTAG)):
+					raise CodeGenerationException ("Command %s comes before a repeat" % str (opcode))
+			for opcode in opcodes [repeatIndex+1:]:
+				if (opcode not in (TAL_CONTENT, TAL_ATTRIBUTES, TAL_OMITTAG, TAL_NOOP)):
+					raise CodeGenerationException ("Command %s comes after a repeat" % str (opcode))
+
+	def emit (self, line):
+		self.lines.append ("\t" * self.indent + line)
+
+	def emitBlock (self, generator, *args):
+		""" Emits an indented block, which must contain at least one statement """
+		self.indent += 1
+		linesBefore = len (self.lines)
+		generator (*args)
+		if (len (self.lines) == linesBefore):
+			self.emit ("pass")
+		self.indent -= 1
+
+	def constant (self, value):
+		""" Returns the name the generated code uses for a value from the program """
+		name = self.constantNames.get (id (value))
+		if (name is None):
+			name = "k%d" % len (self.constants)
+			self.constants.append (value)
+			self.constantNames [id (value)] = name
+		return name
+
+	def generateNodes (self, nodes):
+		for node in nodes:
+			if (isinstance (node, str)):
+				self.emit ("write (%r)" % node)
+			else:
+				self.generateElement (node)
+
+	def generateElement (self, element):
+		names = {}
+		number = self.elementCount
+		self.elementCount += 1
+		for name in ('out', 'content', 'structure', 'forward', 'atts', 'value', 'repeat'):
+			names [name] = "%s%d" % (name, number)
+		opcodes = [opcode for opcode, args in element.commands]
+		contentTypes = set ([args[1] for opcode, args in element.commands if opcode == TAL_CONTENT])
+		names ['hasContent'] = len (contentTypes) > 0
+		if (len (contentTypes) == 1):
+			names ['contentType'] = contentTypes.pop()
+		else:
+			names ['contentType'] = names ['structure']
+		names ['hasForward'] = (TAL_CONTENT in opcodes or METAL_USE_MACRO in opcodes)
+		names ['dynamicAtts'] = (element.startTagArgs[2] is None or TAL_ATTRIBUTES in opcodes)
+		names ['originalAtts'] = self.constant (element.scopeArgs[0])
+		names ['currentAtts'] = self.constant (element.scopeArgs[1])
+
+		self.emit ("%(out)s = 1" % names)
+		if (names ['hasContent']):
+			self.emit ("%(content)s = None" % names)
+		if (names ['hasForward']):
+			self.emit ("%(forward)s = 0" % names)
+		if (names ['dynamicAtts']):
+			self.emit ("%(atts)s = %(currentAtts)s" % names)
+		self.generateCommands (element, names, 0)
+		self.emit ("if (len (outputBuffer) >= flushFragments): outputBuffer.flush()")
+
+	def generateCommands (self, element, names, index):
+		""" Generates the commands on an element from index onwards, followed by its tags and body """
+		if (index == len (element.commands)):
+			self.generateTagsAndBody (element, names)
+			return
+		opcode, args = element.commands [index]
+		if (opcode == TAL_DEFINE):
+			pushed = 0
+			for isLocal, varName, varExpr in args:
+				expression = "evaluate (%s, %s)" % (self.constant (varExpr), names ['originalAtts'])
+				if (isLocal):
+					if (not pushed):
+						pushed = 1
+						self.emit ("%s = %s" % (names ['value'], expression))
+						self.emit ("context.pushLocals ()")
+						self.emit ("context.setLocal (%r, %s)" % (varName, names ['value']))
+					else:
+						self.emit ("context.setLocal (%r, %s)" % (varName, expression))
+				else:
+					self.emit ("context.addGlobal (%r, %s)" % (varName, expression))
+			self.generateCommands (element, names, index + 1)
+			if (pushed):
+				self.emit ("context.popLocals ()")
+		elif (opcode == TAL_CONDITION):
+			self.emit ("if (isConditionTrue (evaluate (%s, %s))):" % (self.constant (args[0]), names ['originalAtts']))
+			self.emitBlock (self.generateCommands, element, names, index + 1)
+		elif (opcode == TAL_REPEAT):
+			self.generateRepeat (element, names, index)
+		elif (opcode == TAL_CONTENT):
+			self.emit ("%s = evaluate (%s, %s)" % (names ['value'], self.constant (args[2]), names ['originalAtts']))
+			self.emit ("if (%(value)s is None):" % names)
+			self.indent += 1
+			if (args[0]):
+				self.emit ("%(out)s = 0" % names)
+			self.emit ("%(forward)s = 1" % names)
+			self.indent -= 1
+			self.emit ("elif (not %(value)s == DEFAULTVALUE):" % names)
+			self.indent += 1
+			if (args[0]):
+				self.emit ("%(out)s = 0" % names)
+			self.emit ("%(content)s = %(value)s" % names)
+			if (names ['contentType'] == names ['structure']):
+				self.emit ("%s = %d" % (names ['structure'], args[1]))
+			self.emit ("%(forward)s = 1" % names)
+			self.indent -= 1
+			self.generateCommands (element, names, index + 1)
+		elif (opcode == TAL_ATTRIBUTES):
+			self.emit ("%s = evaluateAttributes (context, %s, %s, %s)" % (names ['atts'], names ['originalAtts'], self.constant (args), names ['atts']))
+			self.generateCommands (element, names, index + 1)
+		elif (opcode == TAL_OMITTAG):
+			self.emit ("%s = evaluate (%s, %s)" % (names ['value'], self.constant (args), names ['originalAtts']))
+			self.emit ("if (%(value)s is not None and %(value)s): %(out)s = 0" % names)
+			self.generateCommands (element, names, index + 1)
+		elif (opcode == METAL_USE_MACRO):
+			self.emit ("%s = evaluate (%s, %s)" % (names ['value'], self.constant (args[0]), names ['originalAtts']))
+			self.emit ("if (%(value)s is not None and not %(value)s == DEFAULTVALUE and isinstance (%(value)s, SubTemplate)):" % names)
+			self.indent += 1
+			# The macro takes the place of the element, no other commands are run
+			self.emit ("slotParameters = %s" % self.constant (args[1]))
+			self.generateExpandTemplate (names ['value'])
+			self.indent -= 1
+			self.emit ("else:")
+			self.indent += 1
+			self.emit ("if (%(value)s is None):" % names)
+			self.emit ("\t%(out)s = 0" % names)
+			self.emit ("\t%(forward)s = 1" % names)
+			self.generateCommands (element, names, index + 1)
+			self.indent -= 1
+		elif (opcode == METAL_DEFINE_SLOT):
+			self.emit ("if (%r in currentSlots):" % args[0])
+			self.indent += 1
+			# The slot's filling takes the place of the element, no other commands are run
+			self.emit ("%s = currentSlots [%r]" % (names ['value'], args[0]))
+			self.generateWriteContent (names ['value'], 1)
+			self.indent -= 1
+			self.emit ("else:")
+			self.emitBlock (self.generateCommands, element, names, index + 1)
+		else:
+			# TAL_NOOP
+			self.generateCommands (element, names, index + 1)
+
+	def generateRepeat (self, element, names, index):
+		varName, expr, endTagSymbol = element.commands [index][1]
+		self.emit ("%s = startRepeat (context, %r, evaluate (%s, %s))" % (names ['repeat'], varName, self.constant (expr), names ['originalAtts']))
+		self.emit ("if (%(repeat)s is not NOTHING_TO_REPEAT):" % names)
+		self.indent += 1
+		self.emit ("while 1:")
+		self.indent += 1
+		self.generateCommands (element, names, index + 1)
+		self.emit ("if (len (outputBuffer) >= flushFragments): outputBuffer.flush()")
+		self.emit ("if (%(repeat)s is None): break" % names)
+		# Each time round starts with the element as it was before the first
+		self.emit ("%(out)s = 1" % names)
+		if (names ['hasContent']):
+			self.emit ("%(content)s = None" % names)
+		if (names ['hasForward']):
+			self.emit ("%(forward)s = 0" % names)
+		if (names ['dynamicAtts']):
+			self.emit ("%(atts)s = %(currentAtts)s" % names)
+		self.emit ("try:")
+		self.emit ("\t%(repeat)s.increment ()" % names)
+		self.emit ("\tcontext.setLocal (%r, %s.getCurrentValue ())" % (varName, names ['repeat']))
+		self.emit ("except IndexError:")
+		self.emit ("\tcontext.removeRepeat (%r)" % varName)
+		# The locals were pushed in context.addRepeat
+		self.emit ("\tcontext.popLocals ()")
+		self.emit ("\tbreak")
+		self.indent -= 2
+
+	def generateTagsAndBody (self, element, names):
+		tagName, singletonTag, staticTag = element.startTagArgs
+		# The start tag
+		self.emit ("if (%(out)s):" % names)
+		self.indent += 1
+		if (staticTag is not None):
+			if (singletonTag and names ['hasContent']):
+				self.emit ("write (%r if %s is None else %r)" % (staticTag[1], names ['content'], staticTag[0]))
+			else:
+				self.emit ("write (%r)" % staticTag [singletonTag and 1 or 0])
+		else:
+			if (singletonTag and names ['hasContent']):
+				self.emit ("write (tagAsText ((%r, %s), %s is None))" % (tagName, names ['atts'], names ['content']))
+			else:
+				self.emit ("write (tagAsText ((%r, %s), %d))" % (tagName, names ['atts'], singletonTag and 1 or 0))
+		self.indent -= 1
+
+		# The body, skipped when content has replaced it
+		if (names ['hasForward']):
+			self.emit ("if (not %(forward)s):" % names)
+			self.emitBlock (self.generateNodes, element.body)
+		else:
+			self.generateNodes (element.body)
+
+		# The content and end tag
+		if (names ['hasContent']):
+			self.emit ("if (%(content)s is not None):" % names)
+			self.indent += 1
+			self.generateWriteContent (names ['content'], names ['contentType'])
+			self.indent -= 1
+		endTagName, omitTagFlag, singletonEndTag, endTagText = element.endTagArgs
+		if (not omitTagFlag):
+			if (not singletonEndTag):
+				self.emit ("if (%s): write (%r)" % (names ['out'], endTagText))
+			elif (names ['hasContent']):
+				# Singletons only need an end tag when they have been given content
+				self.emit ("if (%s and %s is not None): write (%r)" % (names ['out'], names ['content'], endTagText))
+
+	def generateWriteContent (self, valueName, contentType):
+		""" contentType is 1 for structure, 0 for text, or the name of a variable holding one of these """
+		if (contentType == 1):
+			self.emit ("if (isinstance (%s, Template)):" % valueName)
+			self.indent += 1
+			self.generateExpandTemplate (valueName)
+			self.indent -= 1
+			self.emit ("else:")
+			self.emit ("\twrite (contentAsText (%s))" % valueName)
+		elif (contentType == 0):
+			self.emit ("write (escapedContent (%s))" % valueName)
+		else:
+			self.emit ("if (%s):" % contentType)
+			self.indent += 1
+			self.generateWriteContent (valueName, 1)
+			self.indent -= 1
+			self.emit ("else:")
+			self.indent += 1
+			self.generateWriteContent (valueName, 0)
+			self.indent -= 1
+
+	def generateExpandTemplate (self, valueName):
+		# The interpreter's own state is saved around the other template, just as in cmdEndTagEndScope
+		self.emit ("interpreter.slotParameters = slotParameters")
+		self.emit ("interpreter.pushProgram ()")
+		self.emit ("%s.expandInline (context, outputFile, interpreter)" % valueName)
+		self.emit ("interpreter.popProgram ()")
+		self.emit ("slotParameters = {}")
+
 class TemplateCompiler:
 	def __init__ (self):
 		""" Initialise a template compiler.
@@ -884,7 +1563,7 @@ class TemplateCompiler:
 					self.symbolLocationTable [endTagSymbol] = len (self.commandList)
 					
 					# We need a "close scope and tag" command
-					self.addCommand((TAL_ENDTAG_ENDSCOPE, (tag[0], omitTagFlag, singletonTag)))
+					self.addCommand((TAL_ENDTAG_ENDSCOPE, (tag[0], omitTagFlag, singletonTag, '</' + tag[0] + '>')))
 					return
 				elif (omitTagFlag == 0 and singletonTag == 0):
 					# We are popping off an un-interesting tag, just add the close as text
@@ -1025,13 +1704,20 @@ class TemplateCompiler:
 					# All others just append
 					self.addCommand(cmnd)
 		
+		# Unless tal:attributes can change them, the attributes will always be the
+		# ones we have now, so the tag can be written out once here.
+		if (TAL_ATTRIBUTES in foundTALAtts):
+			staticTag = None
+		else:
+			staticTag = (self.tagAsText ((tag, cleanAttributes)), self.tagAsText ((tag, cleanAttributes), 1))
+		
 		if (firstTag):
 			tagProperties ['originalAtts'] = originalAttributes
-			tagProperties ['command'] = (TAL_STARTTAG, (tag, singletonElement))
+			tagProperties ['command'] = (TAL_STARTTAG, (tag, singletonElement, staticTag))
 			self.addTag ((tag, cleanAttributes), tagProperties)
 		else:		
 			# Add the start tag command in as a child of the last TAL command
-			self.addCommand((TAL_STARTTAG, (tag,singletonElement)))
+			self.addCommand((TAL_STARTTAG, (tag, singletonElement, staticTag)))
 		
 	def parseEndTag (self, tag):
 		""" Just pop the tag and related commands off the stack. """
@@ -1077,7 +1763,7 @@ class TemplateCompiler:
 				varName = stmtBits[0]
 				expression = ' '.join (stmtBits[1:])
 			
-			commandArgs.append ((isLocal, varName, expression))
+			commandArgs.append ((isLocal, varName, simpleTALES.compileExpression (expression)))
 		return (TAL_DEFINE, commandArgs)
 		
 	def compileCmdCondition (self, argument):
@@ -1090,7 +1776,7 @@ class TemplateCompiler:
 			self.log.error (msg)
 			raise TemplateParseException (self.tagAsText (self.currentStartTag), msg)
 	
-		return (TAL_CONDITION, (argument, self.endTagSymbol))
+		return (TAL_CONDITION, (simpleTALES.compileExpression (argument), self.endTagSymbol))
 		
 	def compileCmdRepeat (self, argument):
 		# Compile a repeat command, resulting argument is:
@@ -1104,7 +1790,7 @@ class TemplateCompiler:
 			
 		varName = attProps [0]
 		expression = " ".join (attProps[1:])
-		return (TAL_REPEAT, (varName, expression, self.endTagSymbol))
+		return (TAL_REPEAT, (varName, simpleTALES.compileExpression (expression), self.endTagSymbol))
 	
 	def compileCmdContent (self, argument, replaceFlag=0):
 		# Compile a content command, resulting argument is
@@ -1131,7 +1817,7 @@ class TemplateCompiler:
 				express = argument
 		else:
 			express = argument
-		return (TAL_CONTENT, (replaceFlag, structureFlag, express, self.endTagSymbol))
+		return (TAL_CONTENT, (replaceFlag, structureFlag, simpleTALES.compileExpression (express), self.endTagSymbol))
 		
 	def compileCmdReplace (self, argument):
 		return self.compileCmdContent (argument, replaceFlag=1)
@@ -1156,7 +1842,7 @@ class TemplateCompiler:
 				raise TemplateParseException (self.tagAsText (self.currentStartTag), msg)
 			attName = stmtBits[0]
 			attExpr = " ".join (stmtBits[1:])
-			commandArgs.append ((attName, attExpr))
+			commandArgs.append ((attName, simpleTALES.compileExpression (attExpr)))
 		return (TAL_ATTRIBUTES, commandArgs)
 		
 	def compileCmdOmitTag (self, argument):
@@ -1167,7 +1853,7 @@ class TemplateCompiler:
 			expression = "default"
 		else:
 			expression = argument
-		return (TAL_OMITTAG, expression)
+		return (TAL_OMITTAG, simpleTALES.compileExpression (expression))
 		
 	# METAL compilation commands go here
 	def compileMetalUseMacro (self, argument):
@@ -1177,7 +1863,7 @@ class TemplateCompiler:
 			msg = "No argument passed!  use-macro commands must be of the form: 'use-macro: path'"
 			self.log.error (msg)
 			raise TemplateParseException (self.tagAsText (self.currentStartTag), msg)
-		cmnd = (METAL_USE_MACRO, (argument, {}, self.endTagSymbol))
+		cmnd = (METAL_USE_MACRO, (simpleTALES.compileExpression (argument), {}, self.endTagSymbol))
 		self.log.debug ("Returning METAL_USE_MACRO: %s" % str (cmnd))
 		return cmnd
 		
@@ -33,7 +33,7 @@
 		Module Dependencies: logging
 """
 
-import types, sys
+import types, sys, functools
 
 import logging
 
@@ -292,10 +292,330 @@ class PythonPathFunctions:
 				
 		return defaultValue
 
+# Expressions that are looked up by their text are kept here, so that
+# evaluating the same string twice only parses it once.
+EXPRESSION_CACHE_SIZE = 1000
+_expressionCache = {}
+
+def compileExpression (expr):
+	""" Parses a TALES expression string into an Expression object that can then
+		be evaluated against any Context without being parsed again.
+		Passing an Expression in returns it unchanged.
+	"""
+	if (isinstance (expr, Expression)):
+		return expr
+	try:
+		return _expressionCache [expr]
+	except KeyError:
+		pass
+	# Supports path, exists, nocall, not, string and python
+	text = expr.strip ()
+	if text.startswith ('path:'):
+		result = PathExpression (text[5:].lstrip ())
+	elif text.startswith ('exists:'):
+		result = ExistsExpression (text[7:].lstrip())
+	elif text.startswith ('nocall:'):
+		result = NoCallExpression (text[7:].lstrip())
+	elif text.startswith ('not:'):
+		result = NotExpression (text[4:].lstrip())
+	elif text.startswith ('string:'):
+		result = StringExpression (text[7:].lstrip())
+	elif text.startswith ('python:'):
+		result = PythonExpression (text[7:].lstrip())
+	else:
+		# Not specified - so it's a path
+		result = PathExpression (text)
+	if (len (_expressionCache) >= EXPRESSION_CACHE_SIZE):
+		_expressionCache.clear()
+	_expressionCache [expr] = result
+	return result
+
+class CompiledPath:
+	""" A single path (e.g. 'unit/title' or 'ht/?key') split up ready for traversal.
+		pathList holds the original path elements, steps holds (name, isVariable)
+		for each of them, where isVariable means the name came from a '?' element.
+	"""
+	__slots__ = ('pathList', 'steps')
+	
+	def __init__ (self, expr):
+		# Check for and correct for trailing/leading quotes
+		if (expr.startswith ('"') or expr.startswith ("'")):
+			if (expr.endswith ('"') or expr.endswith ("'")):
+				expr = expr [1:-1]
+			else:
+				expr = expr [1:]
+		elif (expr.endswith ('"') or expr.endswith ("'")):
+			expr = expr [0:-1]
+		self.pathList = tuple (expr.split ('/'))
+		steps = []
+		for path in self.pathList:
+			if path.startswith ('?'):
+				steps.append ((path[1:], 1))
+			else:
+				steps.append ((path, 0))
+		self.steps = tuple (steps)
+		
+	def __str__ (self):
+		return '/'.join (self.pathList)
+		
+class Expression:
+	""" A TALES expression that has already been parsed.  The text it was parsed from
+		is kept as the source, and is what str() returns.
+	"""
+	__slots__ = ('source',)
+	
+	def __init__ (self, source):
+		self.source = source
+		
+	def evaluate (self, context):
+		raise NotImplementedError
+		
+	def __str__ (self):
+		return self.source
+		
+	def __eq__ (self, other):
+		return (self.__class__ is other.__class__ and self.source == other.source)
+		
+	def __hash__ (self):
+		return hash (self.source)
+		
+	def __repr__ (self):
+		return "<%s %s>" % (self.__class__.__name__, repr (self.source))
+		
+class PathExpression (Expression):
+	__slots__ = ('path', 'alternatives')
+	
+	def __init__ (self, source):
+		Expression.__init__ (self, source)
+		allPaths = source.split ('|')
+		if (len (allPaths) > 1):
+			self.path = None
+			self.alternatives = tuple ([compileExpression (path.strip ()) for path in allPaths])
+		else:
+			# A single path - this *can* raise PathNotFoundException when evaluated
+			self.path = CompiledPath (allPaths[0])
+			self.alternatives = ()
+			
+	def evaluate (self, context):
+		if (self.path is not None):
+			return context.traverseCompiledPath (self.path)
+		for alternative in self.alternatives:
+			# Evaluate this path
+			try:
+				return alternative.evaluate (context)
+			except PathNotFoundException as e:
+				# Path didn't exist, try the next one
+				pass
+		# No paths evaluated - raise exception.
+		raise PATHNOTFOUNDEXCEPTION
+		
+class ExistsExpression (Expression):
+	__slots__ = ('path', 'alternatives')
+	
+	def __init__ (self, source):
+		Expression.__init__ (self, source)
+		allPaths = source.split ('|')
+		# The first path is for us
+		self.path = CompiledPath (allPaths[0])
+		self.alternatives = tuple ([compileExpression (path.strip ()) for path in allPaths[1:]])
+		
+	def evaluate (self, context):
+		# Return true if this first bit evaluates, otherwise test the rest
+		try:
+			result = context.traverseCompiledPath (self.path, canCall = 0)
+			return context.true
+		except PathNotFoundException as e:
+			# Look at the rest of the paths.
+			pass
+		for alternative in self.alternatives:
+			try:
+				# If this is part of a "exists: path1 | exists: path2" path then we need to look at the actual result.
+				if (alternative.evaluate (context)):
+					return context.true
+			except PathNotFoundException as e:
+				pass
+		# If we get this far then there are *no* paths that exist.
+		return context.false
+		
+class NoCallExpression (Expression):
+	__slots__ = ('path', 'alternatives')
+	
+	def __init__ (self, source):
+		Expression.__init__ (self, source)
+		allPaths = source.split ('|')
+		# The first path is for us
+		self.path = CompiledPath (allPaths[0])
+		self.alternatives = tuple ([compileExpression (path.strip ()) for path in allPaths[1:]])
+		
+	def evaluate (self, context):
+		try:
+			return context.traverseCompiledPath (self.path, canCall = 0)
+		except PathNotFoundException as e:
+			# Try the rest of the paths.
+			pass
+		for alternative in self.alternatives:
+			try:
+				return alternative.evaluate (context)
+			except PathNotFoundException as e:
+				pass
+		# No path evaluated - raise error
+		raise PATHNOTFOUNDEXCEPTION
+		
+class NotExpression (Expression):
+	__slots__ = ('expression',)
+	
+	def __init__ (self, source):
+		Expression.__init__ (self, source)
+		self.expression = compileExpression (source)
+		
+	def evaluate (self, context):
+		# Evaluate what I was passed
+		try:
+			pathResult = self.expression.evaluate (context)
+		except PathNotFoundException as e:
+			# In SimpleTAL the result of "not: no/such/path" should be TRUE not FALSE.
+			return context.true
+			
+		if (pathResult is None):
+			# Value was Nothing
+			return context.true
+		if (pathResult == DEFAULTVALUE):
+			return context.false
+		try:
+			resultLen = len (pathResult)
+			if (resultLen > 0):
+				return context.false
+			else:
+				return context.true
+		except:
+			# Not a sequence object.
+			pass
+		if (not pathResult):
+			return context.true
+		# Everything else is true, so we return false!
+		return context.false
+		
+# The kinds of segment that make up a string: expression
+STRING_LITERAL = 0
+STRING_EXPRESSION = 1
+STRING_VARIABLE = 2
+
+class StringExpression (Expression):
+	""" The string is split up into literal text, ${expression} and $variable segments
+		when it is parsed, so that only the substitutions are done on evaluation.
+	"""
+	__slots__ = ('segments',)
+	
+	def __init__ (self, source):
+		Expression.__init__ (self, source)
+		segments = []
+		literal = []
+		expr = source
+		skipCount = 0
+		for position in range (0,len (expr)):
+			if (skipCount > 0):
+				skipCount -= 1
+			elif (expr[position] == '$'):
+				if (position + 1 == len (expr)):
+					# Trailing $ sign - just suppress it
+					logging.getLogger ("simpleTALES.Context").warning ("Trailing $ detected")
+				elif (expr[position + 1] == '$'):
+					# Escaped $ sign
+					literal.append ('$')
+					skipCount = 1
+				elif (expr[position + 1] == '{'):
+					# Looking for a path!
+					endPos = expr.find ('}', position + 1)
+					if (endPos > 0):
+						self._addSegment (segments, literal, STRING_EXPRESSION, compileExpression (expr[position + 2:endPos]))
+						skipCount = endPos - position 
+				else:
+					# It's a variable
+					endPos = expr.find (' ', position + 1)
+					if (endPos == -1):
+						endPos = len (expr)
+					self._addSegment (segments, literal, STRING_VARIABLE, CompiledPath (expr [position + 1:endPos]))
+					skipCount = endPos - position - 1
+			else:
+				literal.append (expr[position])
+		if (literal):
+			segments.append ((STRING_LITERAL, "".join (literal)))
+		self.segments = tuple (segments)
+		
+	def _addSegment (self, segments, literal, kind, value):
+		if (literal):
+			segments.append ((STRING_LITERAL, "".join (literal)))
+			del literal[:]
+		segments.append ((kind, value))
+		
+	def evaluate (self, context):
+		result = []
+		for kind, value in self.segments:
+			if (kind == STRING_LITERAL):
+				result.append (value)
+				continue
+			# Missing paths raise exceptions as normal.
+			try:
+				if (kind == STRING_EXPRESSION):
+					pathResult = value.evaluate (context)
+				else:
+					pathResult = context.traverseCompiledPath (value)
+			except PathNotFoundException as e:
+				# This part of the path didn't evaluate to anything - leave blank
+				pathResult = ''
+			if (pathResult is not None):
+				if (isinstance (pathResult, str)):
+					result.append (pathResult)
+				else:
+					# THIS IS NOT A BUG!
+					# Use Unicode in Context if you aren't using Ascii!
+					result.append (str (pathResult))
+		return "".join (result)
+		
+class PythonExpression (Expression):
+	__slots__ = ()
+	
+	def evaluate (self, context):
+		return context.evaluatePython (self.source)
+		
+# The most python: expressions whose compiled code is kept at once.
+PYTHON_CODE_CACHE_SIZE = 500
+
+# Names that python: expressions always see as the helper functions, even
+# if the Context has globals of the same name.
+PYTHON_PATH_FUNCTION_NAMES = ('path', 'string', 'exists', 'nocall', 'test')
+
+@functools.lru_cache (maxsize=PYTHON_CODE_CACHE_SIZE)
+def compilePythonExpression (expr):
+	""" Returns the code object for a python: expression, so that each distinct
+		expression is only compiled once.
+	"""
+	return compile (expr, '<string>', 'eval')
+	
+class PythonLocals (dict):
+	""" The locals seen by a python: expression.  Names are looked up in the
+		Context's locals as they are used, rather than copying them all in
+		beforehand.  Anything the expression assigns is kept in this dict.
+	"""
+	__slots__ = ('contextLocals',)
+	
+	def __init__ (self, contextLocals):
+		dict.__init__ (self)
+		self.contextLocals = contextLocals
+		
+	def __missing__ (self, name):
+		# A KeyError here sends eval on to the globals
+		value = self.contextLocals [name]
+		if (isinstance (value, ContextVariable)): value = value.rawValue()
+		return value
+		
 class Context:
 	def __init__ (self, options=None, allowPythonPath=0):
 		self.allowPythonPath = allowPythonPath
 		self.globals = {}
+		# The globals dictionary handed to python: expressions, built when first
+		# needed and then kept up to date by addGlobal.
+		self.pythonGlobals = None
 		self.locals = {}
 		self.localStack = []
 		self.repeatStack = []
@@ -325,6 +645,9 @@ class Context:
 		
 	def addGlobal (self, name, value):
 		self.globals[name] = value
+		if (self.pythonGlobals is not None and name not in PYTHON_PATH_FUNCTION_NAMES):
+			if (isinstance (value, ContextVariable)): value = value.rawValue()
+			self.pythonGlobals [name] = value
 		
 	def pushLocals (self):
 		# Push the current locals onto a stack so that we can safely over-ride them.
@@ -340,7 +663,7 @@ class Context:
 		
 	def evaluate (self, expr, originalAtts = None):
 		# Returns a ContextVariable
-		#self.log.debug ("Evaluating %s" % expr)
+		# expr is either an Expression or the text of one
 		if (originalAtts is not None):
 			# Call from outside
 			self.globals['attrs'] = originalAtts
@@ -348,24 +671,10 @@ class Context:
 		else:
 			suppressException = 0
 			
-		# Supports path, exists, nocall, not, and string
-		expr = expr.strip ()
+		if (not isinstance (expr, Expression)):
+			expr = compileExpression (expr)
 		try:
-			if expr.startswith ('path:'):
-				return self.evaluatePath (expr[5:].lstrip ())
-			elif expr.startswith ('exists:'):
-				return self.evaluateExists (expr[7:].lstrip())
-			elif expr.startswith ('nocall:'):
-				return self.evaluateNoCall (expr[7:].lstrip())
-			elif expr.startswith ('not:'):
-				return self.evaluateNot (expr[4:].lstrip())
-			elif expr.startswith ('string:'):
-				return self.evaluateString (expr[7:].lstrip())
-			elif expr.startswith ('python:'):
-				return self.evaluatePython (expr[7:].lstrip())
-			else:
-				# Not specified - so it's a path
-				return self.evaluatePath (expr)
+			return expr.evaluate (self)
 		except PathNotFoundException as e:
 			if (suppressException):
 				return None
@@ -377,23 +686,26 @@ class Context:
 			return self.false
 		#self.log.debug ("Evaluating python expression %s" % expr)
 		
-		globals={}
-		for name, value in list(self.globals.items()):
-			if (isinstance (value, ContextVariable)): value = value.rawValue()
-			globals [name] = value
-		globals ['path'] = self.pythonPathFuncs.path
-		globals ['string'] = self.pythonPathFuncs.string
-		globals ['exists'] = self.pythonPathFuncs.exists
-		globals ['nocall'] = self.pythonPathFuncs.nocall
-		globals ['test'] = self.pythonPathFuncs.test
-			
-		locals={}
-		for name, value in list(self.locals.items()):
-			if (isinstance (value, ContextVariable)): value = value.rawValue()
-			locals [name] = value
+		globals = self.pythonGlobals
+		if (globals is None):
+			globals={}
+			for name, value in list(self.globals.items()):
+				if (isinstance (value, ContextVariable)): value = value.rawValue()
+				globals [name] = value
+			globals ['path'] = self.pythonPathFuncs.path
+			globals ['string'] = self.pythonPathFuncs.string
+			globals ['exists'] = self.pythonPathFuncs.exists
+			globals ['nocall'] = self.pythonPathFuncs.nocall
+			globals ['test'] = self.pythonPathFuncs.test
+			self.pythonGlobals = globals
+		else:
+			# evaluate() sets attrs directly for every tag
+			attrs = self.globals ['attrs']
+			if (isinstance (attrs, ContextVariable)): attrs = attrs.rawValue()
+			globals ['attrs'] = attrs
 			
 		try:
-			result = eval(expr, globals, locals)
+			result = eval(compilePythonExpression (expr), globals, PythonLocals (self.locals))
 			if (isinstance (result, ContextVariable)):
 				return result.value()
 			return result
@@ -404,170 +716,34 @@ class Context:
 
 	def evaluatePath (self, expr):
 		#self.log.debug ("Evaluating path expression %s" % expr)
-		allPaths = expr.split ('|')
-		if (len (allPaths) > 1):
-			for path in allPaths:
-				# Evaluate this path
-				try:
-					return self.evaluate (path.strip ())
-				except PathNotFoundException as e:
-					# Path didn't exist, try the next one
-					pass
-			# No paths evaluated - raise exception.
-			raise PATHNOTFOUNDEXCEPTION
-		else:
-			# A single path - so let's evaluate it.
-			# This *can* raise PathNotFoundException
-			return self.traversePath (allPaths[0])
+		return PathExpression (expr).evaluate (self)
 	
 	def evaluateExists (self, expr):
 		#self.log.debug ("Evaluating %s to see if it exists" % expr)
-		allPaths = expr.split ('|')
-		# The first path is for us
-		# Return true if this first bit evaluates, otherwise test the rest
-		try:
-			result = self.traversePath (allPaths[0], canCall = 0)
-			return self.true
-		except PathNotFoundException as e:
-			# Look at the rest of the paths.
-			pass
-			
-		for path in allPaths[1:]:
-			# Evaluate this path
-			try:
-				pathResult = self.evaluate (path.strip ())
-				# If this is part of a "exists: path1 | exists: path2" path then we need to look at the actual result.
-				if (pathResult):
-					return self.true
-			except PathNotFoundException as e:
-				pass
-		# If we get this far then there are *no* paths that exist.
-		return self.false
+		return ExistsExpression (expr).evaluate (self)
 			
 	def evaluateNoCall (self, expr):
 		#self.log.debug ("Evaluating %s using nocall" % expr)
-		allPaths = expr.split ('|')
-		# The first path is for us
-		try:
-			return self.traversePath (allPaths[0], canCall = 0)
-		except PathNotFoundException as e:
-			# Try the rest of the paths.
-			pass
-			
-		for path in allPaths[1:]:
-			# Evaluate this path
-			try:
-				return self.evaluate (path.strip ())
-			except PathNotFoundException as e:
-				pass
-		# No path evaluated - raise error
-		raise PATHNOTFOUNDEXCEPTION
+		return NoCallExpression (expr).evaluate (self)
 			
 	def evaluateNot (self, expr):
 		#self.log.debug ("Evaluating NOT value of %s" % expr)
-		
-		# Evaluate what I was passed
-		try:
-			pathResult = self.evaluate (expr)
-		except PathNotFoundException as e:
-			# In SimpleTAL the result of "not: no/such/path" should be TRUE not FALSE.
-			return self.true
-			
-		if (pathResult is None):
-			# Value was Nothing
-			return self.true
-		if (pathResult == DEFAULTVALUE):
-			return self.false
-		try:
-			resultLen = len (pathResult)
-			if (resultLen > 0):
-				return self.false
-			else:
-				return self.true
-		except:
-			# Not a sequence object.
-			pass
-		if (not pathResult):
-			return self.true
-		# Everything else is true, so we return false!
-		return self.false
+		return NotExpression (expr).evaluate (self)
 		
 	def evaluateString (self, expr):
 		#self.log.debug ("Evaluating String %s" % expr)
-		result = ""
-		skipCount = 0
-		for position in range (0,len (expr)):
-			if (skipCount > 0):
-				skipCount -= 1
-			else:
-				if (expr[position] == '$'):
-					try:
-						if (expr[position + 1] == '$'):
-							# Escaped $ sign
-							result += '$'
-							skipCount = 1
-						elif (expr[position + 1] == '{'):
-							# Looking for a path!
-							endPos = expr.find ('}', position + 1)
-							if (endPos > 0):
-								path = expr[position + 2:endPos]
-								# Evaluate the path - missing paths raise exceptions as normal.
-								try:
-									pathResult = self.evaluate (path)
-								except PathNotFoundException as e:
-									# This part of the path didn't evaluate to anything - leave blank
-									pathResult = ''
-								if (pathResult is not None):
-									if (isinstance (pathResult, str)):
-										result += pathResult
-									else:
-										# THIS IS NOT A BUG!
-										# Use Unicode in Context if you aren't using Ascii!
-										result += str (pathResult)
-								skipCount = endPos - position 
-						else:
-							# It's a variable
-							endPos = expr.find (' ', position + 1)
-							if (endPos == -1):
-								endPos = len (expr)
-							path = expr [position + 1:endPos]
-							# Evaluate the variable - missing paths raise exceptions as normal.
-							try:
-								pathResult = self.traversePath (path)
-							except PathNotFoundException as e:
-								# This part of the path didn't evaluate to anything - leave blank
-								pathResult = ''
-							if (pathResult is not None):
-								if (isinstance (pathResult, str)):
-										result += pathResult
-								else:
-									# THIS IS NOT A BUG!
-									# Use Unicode in Context if you aren't using Ascii!
-									result += str (pathResult)
-							skipCount = endPos - position - 1
-					except IndexError as e:
-						# Trailing $ sign - just suppress it
-						self.log.warning ("Trailing $ detected")
-						pass
-				else:
-					result += expr[position]
-		return result
+		return StringExpression (expr).evaluate (self)
 					
 	def traversePath (self, expr, canCall=1):
+		return self.traverseCompiledPath (CompiledPath (expr), canCall)
+		
+	def traverseCompiledPath (self, compiledPath, canCall=1):
 		# canCall only applies to the *final* path destination, not points down the path.
-		# Check for and correct for trailing/leading quotes
-		if (expr.startswith ('"') or expr.startswith ("'")):
-			if (expr.endswith ('"') or expr.endswith ("'")):
-				expr = expr [1:-1]
-			else:
-				expr = expr [1:]
-		elif (expr.endswith ('"') or expr.endswith ("'")):
-			expr = expr [0:-1]
-		pathList = expr.split ('/')
+		pathList = compiledPath.pathList
+		steps = compiledPath.steps
 		
-		path = pathList[0]
-		if path.startswith ('?'):
-			path = path[1:]
+		path, isVariable = steps[0]
+		if isVariable:
 			if path in self.locals:
 				path = self.locals[path]
 				if (isinstance (path, ContextVariable)): path = path.value()
@@ -586,10 +762,9 @@ class Context:
 			# If we can't find it then raise an exception
 			raise PATHNOTFOUNDEXCEPTION
 		index = 1
-		for path in pathList[1:]:
+		for path, isVariable in steps[1:]:
 			#self.log.debug ("Looking for path element %s" % path)
-			if path.startswith ('?'):
-				path = path[1:]
+			if isVariable:
 				if path in self.locals:
 					path = self.locals[path]
 					if (isinstance (path, ContextVariable)): path = path.value()
@@ -34,22 +34,32 @@
 		Module Dependencies: None
 """
 
-import io, os, stat, threading, sys, codecs, cgi, re, types, logging
+import io, os, threading, sys, html, re, types, logging, hashlib, pickle
 from . import __version__, simpleTAL
 
 # This is used to check for already escaped attributes.
 ESCAPED_TEXT_REGEX=re.compile (r"\&\S+?;")
 
+# Compiled templates saved by the TemplateCache sit next to the template
+# file, with this added to the name.
+COMPILED_TEMPLATE_SUFFIX = ".compiled"
+
 class TemplateCache:
 	""" A TemplateCache is a multi-thread safe object that caches compiled templates.
-		This cache only works with file based templates, the ctime of the file is 
-		checked on each hit, if the file has changed the template is re-compiled.
+		This cache only works with file based templates, the contents of the file are
+		hashed on each hit, if the file has changed the template is re-compiled.
+		
+		If diskCache is true then each compiled template is also saved next to
+		its template file, and loaded from there by later processes for as long
+		as the template source and the simpleTAL version stay the same.
 	"""
-	def __init__ (self):
+	def __init__ (self, diskCache=0):
 		self.templateCache = {}
 		self.cacheLock = threading.Lock()
+		self.diskCache = diskCache
 		self.hits = 0
 		self.misses = 0
+		self.diskHits = 0
 		
 	def getTemplate (self, name, inputEncoding='utf-8'):
 		""" Name should be the path of a template file.  If the path ends in 'xml' it is treated
@@ -59,53 +69,98 @@ class TemplateCache:
 			inputEncoding is only used for HTML templates, and should be the encoding that the template
 			is stored in.
 		"""
-		if (name in self.templateCache):
-			template, oldctime = self.templateCache [name]
-			ctime = os.stat (name)[stat.ST_MTIME]
-			if (oldctime == ctime):
-				# Cache hit!
-				self.hits += 1
-				return template
-		# Cache miss, let's cache this template
-		return self._cacheTemplate_ (name, inputEncoding)
+		return self._getTemplate_ (name, inputEncoding)
 		
 	def getXMLTemplate (self, name):
 		""" Name should be the path of an XML template file.  
 		"""
-		if (name in self.templateCache):
-			template, oldctime = self.templateCache [name]
-			ctime = os.stat (name)[stat.ST_MTIME]
-			if (oldctime == ctime):
-				# Cache hit!
-				self.hits += 1
-				return template
+		return self._getTemplate_ (name, None, xmlTemplate=1)
+		
+	def evict (self, name):
+		""" Forgets the template compiled from name, so the next request compiles it afresh. """
+		self.cacheLock.acquire ()
+		try:
+			self.templateCache.pop (name, None)
+		finally:
+			self.cacheLock.release()
+		
+	def _getTemplate_ (self, name, inputEncoding, xmlTemplate=0):
+		tempFile = open (name, 'rb')
+		try:
+			source = tempFile.read()
+		finally:
+			tempFile.close()
+		if (not xmlTemplate):
+			# We have to guess...
+			firstline = source.split (b'\n', 1)[0]
+			if (name [-3:] == "xml") or (firstline.strip ()[:5] == b'<?xml') or (firstline [:9] == b'<!DOCTYPE' and firstline.find(b'XHTML') != -1):
+				xmlTemplate = 1
+		# Everything that affects the compiled result goes into the key, which
+		# is what decides if the cached template is still good
+		key = (simpleTAL.__version__, simpleTAL.PROGRAM_FORMAT_VERSION, xmlTemplate
+				, inputEncoding, hashlib.sha256 (source).hexdigest())
+		cached = self.templateCache.get (name)
+		if (cached is not None and cached [1] == key):
+			# Cache hit!
+			self.hits += 1
+			return cached [0]
 		# Cache miss, let's cache this template
-		return self._cacheTemplate_ (name, None, xmlTemplate=1)
+		return self._cacheTemplate_ (name, source, key)
 		
-	def _cacheTemplate_ (self, name, inputEncoding, xmlTemplate=0):
+	def _cacheTemplate_ (self, name, source, key):
+		inputEncoding, xmlTemplate = key [3], key [2]
 		self.cacheLock.acquire ()
 		try:
-			tempFile = open (name, 'rb')
-			if (xmlTemplate):
-				# We know it is XML
-				template = simpleTAL.compileXMLTemplate (tempFile)
-			else:
-				# We have to guess...
-				firstline = tempFile.readline()
-				tempFile.seek(0)
-				if (name [-3:] == "xml") or (firstline.strip ()[:5] == b'<?xml') or (firstline [:9] == b'<!DOCTYPE' and firstline.find(b'XHTML') != -1):
-					template = simpleTAL.compileXMLTemplate (tempFile)
+			template = None
+			if (self.diskCache):
+				template = self._loadCompiled_ (name, key)
+			if (template is None):
+				if (xmlTemplate):
+					template = simpleTAL.compileXMLTemplate (source)
 				else:
-					template = simpleTAL.compileHTMLTemplate (codecs.lookup (inputEncoding).streamreader(tempFile))
-			tempFile.close()
-			self.templateCache [name] = (template, os.stat (name)[stat.ST_MTIME])
+					template = simpleTAL.compileHTMLTemplate (str (source, inputEncoding))
+				if (self.diskCache):
+					self._saveCompiled_ (name, key, template)
+			else:
+				self.diskHits += 1
+			self.templateCache [name] = (template, key)
 			self.misses += 1
-		except Exception as e:
+		finally:
 			self.cacheLock.release()
-			raise e
-			
-		self.cacheLock.release()
 		return template
+		
+	def _loadCompiled_ (self, name, key):
+		""" Returns the template saved for this key, or None if there isn't one. """
+		try:
+			compiledFile = open (name + COMPILED_TEMPLATE_SUFFIX, 'rb')
+			try:
+				savedKey, template = pickle.load (compiledFile)
+			finally:
+				compiledFile.close()
+		except Exception as e:
+			# Missing, unreadable or from an incompatible version - compile afresh.
+			return None
+		if (savedKey != key):
+			return None
+		return template
+		
+	def _saveCompiled_ (self, name, key, template):
+		compiledName = name + COMPILED_TEMPLATE_SUFFIX
+		tempName = "%s.%d.tmp" % (compiledName, os.getpid())
+		try:
+			compiledFile = open (tempName, 'wb')
+			try:
+				pickle.dump ((key, template), compiledFile, pickle.HIGHEST_PROTOCOL)
+			finally:
+				compiledFile.close()
+			os.replace (tempName, compiledName)
+		except (OSError, pickle.PicklingError) as e:
+			# Not being able to save is no reason to stop
+			logging.getLogger ("simpleTALUtils.TemplateCache").warning ("Could not save compiled template %s: %s" % (compiledName, str (e)))
+			try:
+				os.remove (tempName)
+			except OSError:
+				pass
 
 def tagAsText (tag,atts):
 	result = "<" + tag 
@@ -114,7 +169,7 @@ def tagAsText (tag,atts):
 			# We already have some escaped characters in here, so assume it's all valid
 			result += ' %s="%s"' % (name, value)
 		else:
-			result += ' %s="%s"' % (name, cgi.escape (value))
+			result += ' %s="%s"' % (name, html.escape (value, quote=False))
 	result += ">"
 	return result
 
@@ -161,14 +216,16 @@ class MacroExpansionInterpreter (simpleTAL.TemplateInterpreter):
 				newAtts.append ((att, value))
 		self.macroArg = None
 		self.currentAttributes = newAtts
-		simpleTAL.TemplateInterpreter.cmdOutputStartTag (self, command, args)
+		# The attributes have been rewritten, so the tag can't be output as compiled
+		tagName, singletonTag, staticTag = args
+		simpleTAL.TemplateInterpreter.cmdOutputStartTag (self, command, (tagName, singletonTag, None))
 		
 	def cmdUseMacro (self, command, args):
 		simpleTAL.TemplateInterpreter.cmdUseMacro (self, command, args)
 		if (self.tagContent is not None):
 			# We have a macro, add the args to the in-macro list
 			self.inMacro = 1
-			self.macroArg = args[0]
+			self.macroArg = str (args[0])
 			
 	def cmdEndTagEndScope (self, command, args):
 		# Args: tagName, omitFlag
@@ -195,11 +252,11 @@ class MacroExpansionInterpreter (simpleTAL.TemplateInterpreter):
 						self.file.write (str (str (resultVal), 'ascii'))
 			else:
 				if (isinstance (resultVal, str)):
-					self.file.write (cgi.escape (resultVal))
+					self.file.write (html.escape (resultVal, quote=False))
 				elif (isinstance (resultVal, bytes)):
-					self.file.write (cgi.escape (str (resultVal, 'ascii')))
+					self.file.write (html.escape (str (resultVal, 'ascii'), quote=False))
 				else:
-					self.file.write (cgi.escape (str (str (resultVal), 'ascii')))
+					self.file.write (html.escape (str (str (resultVal), 'ascii'), quote=False))
 					
 		if (self.outputTag and not args[1]):
 			self.file.write ('</' + args[0] + '>')
@@ -1,11 +1,14 @@
-import unittest
-from buildschemes import SchemeLibrary, Scheme, SchemeUnit
+import unittest, unittest.mock, os, threading, urllib.request, urllib.error, tempfile
+import buildschemes
+from buildschemes import SchemeLibrary, Scheme, SchemeUnit, PreviewServer
+from simpletal import simpleTAL, simpleTALES, simpleTALUtils
 
 class TestBuildSchemes(unittest.TestCase):
 
     def setUp(self):
         self.lib = SchemeLibrary(config_ini_path = 'test_config/settings.ini')
         self.lib.loadSchemes()
+        os.makedirs(self.lib.output_path, exist_ok=True)
 
     def test_loadingSchemes(self):
         self.assertEqual(len(self.lib.getSchemeIds()), 2)
@@ -16,6 +19,77 @@ class TestBuildSchemes(unittest.TestCase):
         s = Scheme('bogus')
         u = s.addUnit('algebra1', "Algebra 1", 9, "learn", "fakename.doc")
         self.assertEqual(len(s.units),1)
+        self.assertIs(s.getUnit('ALGEBRA1'), u)
+        self.assertIs(s.findUnit('Algebra1'), u)
+        self.assertIsNone(s.findUnit('algebra2'))
+        self.assertRaises(ValueError, s.addUnit, 'Algebra1', "Again", 9, "learn", None)
+        self.assertRaises(ValueError, s.getUnit, 'algebra2')
+        self.assertEqual(s.getUnitsForHT(9), [u])
+        self.assertEqual(s.getUnitsForHT(1), [])
+        s.getUnitsForHT(9).append("not a unit")
+        self.assertEqual(s.getUnitsForHT(9), [u])
+
+    def test_objectiveStore(self):
+        s = Scheme('bogus')
+        a = s.addUnit('a', "A", 1, "learn", None)
+        b = s.addUnit('b', "B", 1, "learn", None)
+        a.appendObjective("a1")
+        b.appendObjective("b1")
+        before = a.getObjectives()
+        a.appendObjective("a2")
+        self.assertEqual(before, ["a1"])
+        self.assertEqual(a.getObjectives(), ["a1", "a2"])
+        self.assertEqual(b.getObjectives(), ("b1",))
+        self.assertFalse(hasattr(a.getObjectives(), "append"))
+
+        # moving a2's run to the end left a copy of a1 behind
+        self.assertEqual(s.objectives, ["a1", "b1", "a1", "a2"])
+        self.assertEqual(b.getObjectives()[-1], "b1")
+
+    def test_findTargetFiles(self):
+        with tempfile.TemporaryDirectory() as output_path:
+            os.makedirs(os.path.join(output_path, "units"))
+            for name in ("index.pdf", os.path.join("units", "a.pdf"), os.path.join("units", "b.pdf")):
+                open(os.path.join(output_path, name), "w").close()
+            self.lib.output_path = output_path
+            names = ["index.pdf", "missing.pdf", os.path.join("units", "a.pdf"),
+                     os.path.join("units", "b.pdf"), os.path.join("gone", "c.pdf")]
+            with unittest.mock.patch("os.listdir", wraps = os.listdir) as listdir:
+                found = self.lib.findTargetFiles(names)
+            self.assertEqual(found, set(names[:1] + names[2:4]))
+            self.assertEqual(listdir.call_count, 3)
+
+    def test_assessments(self):
+        # nothing in the test Assessments.csv is for the schemes we build
+        self.assertEqual(self.lib.getQuestions('y12m', 'test-initial'), ())
+
+        with tempfile.TemporaryDirectory() as config_path:
+            with open(os.path.join(config_path, 'Assessments.csv'), 'w', encoding="utf-8") as f:
+                f.write('"scheme_id","unit_id","q","description","level"\n'
+                        '"y12m","TEST-INITIAL","1a","Surds",6\n'
+                        '"e8","ht1-test","a1","Addition/subtraction decimals",\n'
+                        '"y12m","test-initial","1b","Indices",\n'
+                        '"y12m","no-such-unit","1","Vectors",7\n')
+            self.lib.config_path = config_path
+            self.lib.loadAssessments()
+        questions = self.lib.getQuestions('y12m', 'test-initial')
+        self.assertEqual([(q.q, q.description, q.level) for q in questions],
+                         [("1a", "Surds", "6"), ("1b", "Indices", "")])
+        self.assertEqual(self.lib.getScheme('y12fm').getUnit('test-initial').questions, ())
+        self.assertEqual(self.lib.getQuestions('y12m', 'no-such-unit'), ())
+        self.assertEqual(self.lib.getQuestions('no-such-scheme', 'test-initial'), ())
+
+        context = self.lib.makeContext()
+        context.addGlobal('thisascheme', self.lib.getAllocatedSchemes()[0])
+        page = self.lib.getTemplate("details.html").expand(context)
+        self.assertIn('<td>1a</td>', page)
+        self.assertIn('<td>Indices</td>', page)
+
+        # once the file has gone, so have the questions
+        with tempfile.TemporaryDirectory() as config_path:
+            self.lib.config_path = config_path
+            self.lib.loadAssessments()
+        self.assertEqual(self.lib.getQuestions('y12m', 'test-initial'), ())
 
     def test_schedulingOfUnits(self):
         sch = self.lib.getScheme('y12m')
@@ -24,7 +98,269 @@ class TestBuildSchemes(unittest.TestCase):
         self.assertEqual(units[2].title, "Vectors (2D)")
 
     def test_outputHTML(self):
-        self.lib.writeHTML()
+        self.lib.writeHTML(force = True)
+        self.assertEqual(self.lib.templates.misses, 2)
+        self.lib.writeHTML(force = True)
+        self.assertEqual(self.lib.templates.misses, 2)
+        self.assertEqual(self.lib.templates.hits, 2)
+
+    def _readOutput(self):
+        pages = {}
+        for ascheme in self.lib.getAllocatedSchemes():
+            fname = ascheme.getDetailsFileName()
+            with open(os.path.join(self.lib.output_path, fname), encoding="utf-8") as f:
+                pages[fname] = f.read()
+        return pages
+
+    def test_outputHTMLInParallel(self):
+        self.lib.writeHTML(force = True)
+        serial = self._readOutput()
+        for fname in serial:
+            os.remove(os.path.join(self.lib.output_path, fname))
+        self.lib.writeHTML(jobs = 2)
+        self.assertEqual(self._readOutput(), serial)
+
+    def test_incrementalOutput(self):
+        self.lib.writeHTML(force = True)
+        self.assertEqual(self.lib.writeHTML(), [])
+        # the record of the build is kept out of the published folder
+        self.assertNotIn(buildschemes.MANIFEST_NAME, os.listdir(self.lib.output_path))
+        self.assertTrue(os.path.exists(os.path.join(self.lib.cache_path, buildschemes.MANIFEST_NAME)))
+
+        # only the groups using y12fm should need writing again
+        self.lib.getScheme('y12fm').units[0].appendObjective("a new objective")
+        written = self.lib.writeHTML()
+        self.assertEqual(sorted(written),
+                         ["scheme-year-12-further-maths.html", "scheme-year-9-genius.html"])
+        self.assertEqual(self.lib.writeHTML(), [])
+
+        # anything missing from the target folder gets written again
+        os.remove(os.path.join(self.lib.output_path, "index.html"))
+        self.assertEqual(self.lib.writeHTML(), ["index.html"])
+
+    def test_unchangedOutputNotRewritten(self):
+        self.lib.writeHTML(force = True)
+        pages = self._readOutput()
+        paths = [os.path.join(self.lib.output_path, fname) for fname in pages]
+        for path in paths:
+            os.utime(path, ns = (0, 0))
+
+        # rendering everything again gives the same pages, so nothing is touched
+        self.assertEqual(self.lib.writeHTML(force = True), [])
+        self.assertEqual([os.stat(path).st_mtime_ns for path in paths], [0] * len(paths))
+
+        # a page that no longer matches what is rendered is replaced
+        fname = sorted(pages)[0]
+        with open(os.path.join(self.lib.output_path, fname), "a", encoding="utf-8") as f:
+            f.write("edited by hand")
+        self.assertEqual(self.lib.writeHTML(force = True), [fname])
+        self.assertEqual(self._readOutput(), pages)
+        self.assertEqual([name for name in os.listdir(self.lib.output_path)
+                          if name.endswith(".tmp")], [])
+
+    def test_snapshot(self):
+        snapshot_path = os.path.join(self.lib.cache_path, buildschemes.SNAPSHOT_NAME)
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        try:
+            self.lib.saveSnapshot()
+            self.assertTrue(os.path.exists(snapshot_path))
+            self.assertNotIn(buildschemes.SNAPSHOT_NAME, os.listdir(self.lib.output_path))
+            lib = SchemeLibrary(config_ini_path = 'test_config/settings.ini')
+            self.assertTrue(lib.loadSnapshot())
+            self.assertEqual(sorted(lib.getSchemeIds()), sorted(self.lib.getSchemeIds()))
+            for sid in lib.getSchemeIds():
+                self.assertEqual(lib.getScheme(sid).getDigest(), self.lib.getScheme(sid).getDigest())
+            self.assertEqual([a.getTitle() for a in lib.getAllocatedSchemes()],
+                             [a.getTitle() for a in self.lib.getAllocatedSchemes()])
+            self.assertIs(lib.getAllocatedSchemes()[0].scheme, lib.getScheme('y12m'))
+            self.assertEqual(lib.half_terms, self.lib.half_terms)
+
+            # a snapshot of config files that have since changed is not used
+            sources = lib.describeConfigFiles()
+            sources['Objectives.csv'] = "not the same"
+            lib.saveSnapshot(sources)
+            lib = SchemeLibrary(config_ini_path = 'test_config/settings.ini')
+            lib.loadSchemes(use_snapshot = True)
+            self.assertEqual(len(lib.getScheme('y12m').getUnit('1pure5').getObjectives()),6)
+            self.assertTrue(lib.loadSnapshot())
+        finally:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+
+    def test_reload(self):
+        scheme = self.lib.getScheme('y12m')
+        self.lib.reload(['HalfTerms.csv'])
+        self.assertIs(self.lib.getScheme('y12m'), scheme)
+        self.assertEqual(len(self.lib.half_terms), 6)
+
+        self.lib.reload(['Objectives.csv'])
+        self.assertIsNot(self.lib.getScheme('y12m'), scheme)
+        self.assertIs(self.lib.getAllocatedSchemes()[0].scheme, self.lib.getScheme('y12m'))
+        self.assertEqual(len(self.lib.getScheme('y12m').getUnit('1pure5').getObjectives()),6)
+
+    def test_checkForChanges(self):
+        self.lib.writeHTML(force = True)
+        self.lib._watched = self.lib.statWatchedFiles()
+        self.assertIsNone(self.lib.checkForChanges())
+
+        # pretend the objectives have been edited, without changing them
+        objectives_path = os.path.join(self.lib.config_path, 'Objectives.csv')
+        self.lib._watched[objectives_path] = None
+        self.assertEqual(self.lib.checkForChanges(), [])
+        self.assertIsNone(self.lib.checkForChanges())
+
+    def test_previewServer(self):
+        self.lib.writeHTML(force = True)
+        written = self._readOutput()
+        self.lib._watched = self.lib.statWatchedFiles()
+        server = PreviewServer(self.lib, ("127.0.0.1", 0))
+        thread = threading.Thread(target = server.serve_forever)
+        thread.start()
+        asset_path = os.path.join(self.lib.output_path, "preview-test.css")
+        try:
+            url = "http://127.0.0.1:%d/" % server.server_port
+            fname = self.lib.getAllocatedSchemes()[0].getDetailsFileName()
+            with urllib.request.urlopen(url + fname) as response:
+                self.assertEqual(response.read().decode("utf-8"), written[fname])
+            with urllib.request.urlopen(url) as response:
+                with open(os.path.join(self.lib.output_path, "index.html"), encoding="utf-8") as f:
+                    self.assertEqual(response.read().decode("utf-8"), f.read())
+            self.assertEqual(sorted(server.pages), sorted([fname, "index.html"]))
+
+            # anything that isn't a page comes from the target folder
+            with open(asset_path, "w") as f:
+                f.write("body { color: black }")
+            with urllib.request.urlopen(url + "preview-test.css") as response:
+                self.assertEqual(response.read(), b"body { color: black }")
+
+            # the rendered pages are forgotten once the config files change
+            objectives_path = os.path.join(self.lib.config_path, 'Objectives.csv')
+            self.lib._watched[objectives_path] = None
+            with urllib.request.urlopen(url + fname) as response:
+                self.assertEqual(response.read().decode("utf-8"), written[fname])
+            self.assertEqual(list(server.pages), [fname])
+
+            # config files that won't load break the pages, but not the rest
+            def brokenReload(changed):
+                raise ValueError("Scheme [x] is not known")
+            self.lib.reload = brokenReload
+            self.lib._watched[objectives_path] = None
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(url + fname)
+            self.assertEqual(cm.exception.code, 500)
+            cm.exception.close()
+            with urllib.request.urlopen(url + "preview-test.css") as response:
+                self.assertEqual(response.read(), b"body { color: black }")
+            del self.lib.reload
+            self.lib._watched[objectives_path] = None
+            with urllib.request.urlopen(url + fname) as response:
+                self.assertEqual(response.read().decode("utf-8"), written[fname])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            if os.path.exists(asset_path):
+                os.remove(asset_path)
+
+    def test_compiledTemplateCache(self):
+        path = os.path.join('templates', 'details.html')
+        compiled_path = path + simpleTALUtils.COMPILED_TEMPLATE_SUFFIX
+        if os.path.exists(compiled_path):
+            os.remove(compiled_path)
+
+        cache = simpleTALUtils.TemplateCache(diskCache = 1)
+        compiled = cache.getTemplate(path)
+        self.assertEqual(cache.diskHits, 0)
+        self.assertTrue(os.path.exists(compiled_path))
+
+        cache = simpleTALUtils.TemplateCache(diskCache = 1)
+        loaded = cache.getTemplate(path)
+        self.assertEqual(cache.diskHits, 1)
+        self.assertEqual(loaded.commandList, compiled.commandList)
+        self.assertEqual(loaded.symbolTable, compiled.symbolTable)
+
+    def test_templateCacheSeesEdits(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'page.html')
+            with open(path, 'w', encoding="utf-8") as f:
+                f.write('<p tal:content="string:old">x</p>')
+            cache = simpleTALUtils.TemplateCache()
+            context = simpleTALES.Context()
+            self.assertEqual(cache.getTemplate(path).expand(context), '<p>old</p>')
+            self.assertEqual(cache.getTemplate(path).expand(context), '<p>old</p>')
+            self.assertEqual(cache.hits, 1)
+
+            # an edit that leaves the size and time stamp as they were
+            st = os.stat(path)
+            with open(path, 'w', encoding="utf-8") as f:
+                f.write('<p tal:content="string:new">x</p>')
+            os.utime(path, ns = (st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(cache.getTemplate(path).expand(context), '<p>new</p>')
+            self.assertEqual(cache.misses, 2)
+
+            cache.evict(path)
+            self.assertEqual(cache.getTemplate(path).expand(context), '<p>new</p>')
+            self.assertEqual(cache.misses, 3)
+
+    def test_expandToString(self):
+        self.lib.writeHTML(force = True)
+        ascheme = self.lib.getAllocatedSchemes()[0]
+        template = self.lib.getTemplate("details.html")
+        context = self.lib.makeContext()
+        context.addGlobal('thisascheme', ascheme)
+        text = template.expand(context)
+        with open(os.path.join(self.lib.output_path, ascheme.getDetailsFileName()),
+                  encoding="utf-8") as f:
+            self.assertEqual(text, f.read())
+        self.assertEqual(template.expandToBytes(context, "ascii"),
+                         text.encode("ascii", "xmlcharrefreplace"))
+
+    def test_generatedCode(self):
+        # The Python generated from a template has to give the same output as the interpreter
+        source = ('<html><div metal:define-macro="box" class="box">'
+                  '<h2 metal:define-slot="title">Untitled</h2><p tal:replace="nothing">x</p></div>'
+                  '<ul tal:define="count python:len(library.getAllocatedSchemes())">'
+                  '<li tal:repeat="ascheme library/getAllocatedSchemes" class="scheme" '
+                  'tal:attributes="id ascheme/getDetailsFileName; class nothing">'
+                  '<b tal:condition="repeat/ascheme/start">first</b><span tal:replace="ascheme/getTitle">t</span>'
+                  '<i tal:omit-tag="" tal:content="structure string:&lt;em&gt;${repeat/ascheme/number} of ${count}&lt;/em&gt;"/>'
+                  '</li><li tal:repeat="missing nothing">none</li></ul>'
+                  '<div metal:use-macro="template/macros/box"><h2 metal:fill-slot="title" '
+                  'tal:content="string:Schemes">x</h2></div><br tal:condition="library"></html>')
+        template = simpleTAL.compileHTMLTemplate(source)
+        self.assertIsNotNone(template.getGeneratedProgram())
+        context = self.lib.makeContext()
+        context.addGlobal('template', template)
+        self.assertEqual(template.expand(context, useGeneratedCode = 1), template.expand(context))
+
+        template = self.lib.getTemplate("details.html")
+        self.assertIsNotNone(template.getGeneratedProgram())
+        for ascheme in self.lib.getAllocatedSchemes():
+            context.addGlobal('thisascheme', ascheme)
+            self.assertEqual(template.expand(context, useGeneratedCode = 1), template.expand(context))
+
+    def test_iterExpand(self):
+        template = self.lib.getTemplate("details.html")
+        context = self.lib.makeContext()
+        context.addGlobal('thisascheme', self.lib.getAllocatedSchemes()[0])
+        chunks = list(template.iterExpand(context, flushFragments = 1))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), template.expand(context))
+
+        # The output of a macro is streamed as it is produced, and can be stopped part way
+        macro = simpleTAL.compileHTMLTemplate(
+            '<ol metal:define-macro="list"><li tal:repeat="n numbers" tal:content="n">n</li></ol>')
+        page = simpleTAL.compileHTMLTemplate(
+            '<html><div metal:use-macro="macro/macros/list">list</div></html>')
+        context.addGlobal('macro', macro)
+        context.addGlobal('numbers', range(1000))
+        pieces = page.iterExpand(context, flushFragments = 10)
+        first = next(pieces)
+        self.assertTrue(first.startswith('<html><ol><li>0</li><li>1</li>'))
+        self.assertLess(len(first), 100)
+        pieces.close()
+        self.assertEqual("".join(page.iterExpand(context)), page.expand(context))
 
 if __name__ == '__main__':
     unittest.main()